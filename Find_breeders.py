@@ -54,9 +54,12 @@ all_mice = colony.models.Mouse.objects.filter(sack_date__isnull=True)
 #         MP_cages.append(cage)
 
 MP_breeders_l = []
-for mouse in all_mice:
+# Only the mice with the genotypes of interest, from the stored genotype
+for mouse in all_mice.filter(genotype_cache__in=[
+        "DAT-Ires-Cre(+/-); Tfam-flox(+/+)", "Tfam-flox(+/+)"]).select_related(
+        'cage'):
     # mgenes_l = mouse.mousegene_set.all()
-    mgenotype = mouse.genotype
+    mgenotype = mouse.genotype_cache
     # 0 is male, 1 is F, 2 is ?
     msex = mouse.sex
     m_age = mouse.age()
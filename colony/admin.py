@@ -1,17 +1,22 @@
 from builtins import str
 from builtins import object
+import datetime
 from django.contrib import admin
 from .models import (Mouse, Genotype, Litter, 
     Cage, Person, SpecialRequest, HistoricalMouse, Gene, MouseGene,
     Strain, MouseStrain)
 # Register your models here.
-from django.db.models import Count
+from django.db.models import Count, Prefetch
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from simple_history.admin import SimpleHistoryAdmin
 from django.contrib.admin.views.main import ChangeList
 from django.utils.safestring import mark_safe
 from django import forms
 from dal import autocomplete
+from .services import sack_cages
+from .search import search_cages
+from .pagination import EstimatedCountPaginator
 
 class GenotypedFilter(admin.SimpleListFilter):
     """Filter by whether the genotype date is null or not
@@ -155,9 +160,23 @@ class LitterAdmin(admin.ModelAdmin):
         return LitterAdminChangeList
 
     def get_queryset(self, request):
-        """Only return litters that are born."""
+        """Only return litters that are born.
+        
+        Everything that the columns display is fetched along with the
+        litters: the parents and their genes for cross, the mice in the
+        breeding cage for its type, and the special requests. The number
+        of pups is annotated as n_pups, which Litter.info uses.
+        """
         qs = super(LitterAdmin, self).get_queryset(request)
-        return qs.filter(dob__isnull=False)
+        return qs.filter(dob__isnull=False).select_related(
+            'breeding_cage', 'father', 'mother',
+            'mother__cage', # for contains_mother_of_this_litter
+        ).prefetch_related(
+            'father__mousegene_set__gene_name',
+            'mother__mousegene_set__gene_name',
+            'breeding_cage__mouse_set__mousegene_set__gene_name',
+            'breeding_cage__specialrequest_set__requestee',
+        ).annotate(n_pups=Count('mouse'))
 
     def name(self, obj):
         return str(obj)
@@ -176,8 +195,9 @@ class LitterAdmin(admin.ModelAdmin):
     cross.short_description = 'Cross'
     
     def n_pups(self, obj):
-        return obj.mouse_set.count()
+        return obj.n_pups
     n_pups.short_description = 'Size'
+    n_pups.admin_order_field = 'n_pups'
 
 class DefunctFilter(admin.SimpleListFilter):
     """By default, filter by defunct=False
@@ -319,6 +339,7 @@ class CageAdmin(admin.ModelAdmin):
     # Allow searching cages by mouse info
     # Searching by litter__target_genotype allows us to include relevant
     # breeding cages even if the father is out of the picture.
+    # The search itself is done by get_search_results, see colony.search
     search_fields = (
         'name', 
         'mouse__name', 
@@ -348,8 +369,39 @@ class CageAdmin(admin.ModelAdmin):
     # A special form for adding mice
     form = AddMiceToCageForm
 
-    # Pagination to save time
-    list_per_page = 20
+    # Pagination. Every column is computed from the prefetched data in
+    # get_queryset, so a long page costs no more queries than a short one
+    list_per_page = 200
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    # Bulk actions on the selected cages
+    actions = ['sack_selected_cages']
+
+    def get_queryset(self, request):
+        """Fetch everything that the columns display along with the cages.
+        
+        The mice are prefetched in order of name with their litter and
+        user, which is all that Mouse.info() needs. The special requests
+        are prefetched with their requestee, and the litter is joined for
+        target_genotype and auto_needs_message.
+        """
+        qs = super(CageAdmin, self).get_queryset(request)
+        return qs.select_related('proprietor', 'litter').prefetch_related(
+            Prefetch('mouse_set', queryset=Mouse.objects.order_by(
+                'name').select_related('litter', 'user')),
+            'specialrequest_set__requestee',
+        )
+
+    def get_search_results(self, request, queryset, search_term):
+        """Search the indexed CageSearchDocument instead of joining mice.
+        
+        This matches the same cages as search_fields would, without
+        joining every mouse, gene, and strain, so no DISTINCT is needed.
+        """
+        if not search_term:
+            return queryset, False
+        return search_cages(queryset, search_term), False
 
     ## Define what shows up on the individual cage admin page
     # Clickable links to every mouse in the cage
@@ -357,7 +409,8 @@ class CageAdmin(admin.ModelAdmin):
     def link_to_mice(self, obj):
         """Generate HTML links for every mouse in the cage"""
         link_html_code = ''
-        for child in obj.mouse_set.order_by('name').all():
+        # Already ordered by name, see get_queryset
+        for child in obj.mouse_set.all():
             child_link = reverse("admin:colony_mouse_change", 
                 args=[child.id])
             child_info = child.info()
@@ -392,6 +445,14 @@ class CageAdmin(admin.ModelAdmin):
     )
 
     
+    def sack_selected_cages(self, request, queryset):
+        """Make the selected cages defunct and sack their mice"""
+        n_cages, n_mice = sack_cages(queryset.values_list('pk', flat=True))
+        self.message_user(request, 'Sacked %d cages and %d mice.' % (
+            n_cages, n_mice))
+    sack_selected_cages.short_description = (
+        'Sack selected cages and their mice')
+
     # Override the width of the charfield for rack_spot
     def formfield_for_dbfield(self, db_field, **kwargs):
         if db_field.name == 'rack_spot':
@@ -432,8 +493,8 @@ class MouseAdmin(admin.ModelAdmin):
         'user', 
         'pure_breeder', 
         'sacked', 
-        'strain_description',
-        'genotype', 
+        'strain_cache',
+        'genotype_cache', 
         'sex', 
         'dob', 
         'age', 
@@ -453,6 +514,7 @@ class MouseAdmin(admin.ModelAdmin):
         SackFilter, 
         'mousestrain__strain_key__name',
         'mousegene__gene_name__name',
+        'genotype_cache',
         'sex',
     ]
     search_fields = (
@@ -466,8 +528,37 @@ class MouseAdmin(admin.ModelAdmin):
     # How it is sorted by default
     ordering = ('name',)
     
-    # Pagination to save time
+    # Pagination to save time, without counting every mouse
     list_per_page = 20
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        """Join everything that the columns display, and annotate the DOB.
+        
+        annotated_dob is the same as Mouse.dob, computed in the database,
+        so that the dob and age columns can be sorted on.
+        """
+        qs = super(MouseAdmin, self).get_queryset(request)
+        return qs.select_related('cage', 'litter', 'user').annotate(
+            annotated_dob=Coalesce('manual_dob', 'litter__dob'))
+
+    ## Sortable columns computed from the annotated queryset
+    def dob(self, obj):
+        return obj.annotated_dob
+    dob.admin_order_field = 'annotated_dob'
+
+    def age(self, obj):
+        if obj.annotated_dob is None:
+            return None
+        return (datetime.date.today() - obj.annotated_dob).days
+    # Older mice were born earlier
+    age.admin_order_field = '-annotated_dob'
+
+    def sacked(self, obj):
+        return obj.sacked
+    # Unsacked mice (null sack_date) sort first
+    sacked.admin_order_field = '-sack_date'
 
     ## Ordering for choosing cage for mouse
     # http://stackoverflow.com/questions/8992865/django-admin-sort-foreign-key-field-list
@@ -623,6 +714,10 @@ class HistoricalMouseAdmin(admin.ModelAdmin):
         )
     change_list_template = 'admin/colony/historicalmouse/change_list.html'
 
+    # The history only grows, so do not count all of it on every page
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
 
 admin.site.register(HistoricalMouse, HistoricalMouseAdmin)
 admin.site.register(Mouse, MouseAdmin)
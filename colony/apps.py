@@ -5,3 +5,8 @@ from django.apps import AppConfig
 
 class ColonyConfig(AppConfig):
     name = 'colony'
+
+    def ready(self):
+        # Connect the signal handlers that keep the census rows and the
+        # autocomplete cache up to date
+        from . import signals
@@ -0,0 +1,227 @@
+"""Functions for building the census from the CageCensusRow snapshots.
+
+Each non-defunct cage in the census is displayed as a few table rows. These
+rows are expensive to compute, so they are stored in CageCensusRow and only
+recomputed when they are stale. The signal handlers in colony.signals call
+mark_cages_stale and mark_mice_stale whenever something displayed in the
+census changes. Code that writes with QuerySet.update or bulk_create does
+not send those signals, so it must call them directly.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import functools
+import operator
+
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+
+from .models import Cage, CageCensusRow
+
+
+def prefetch_for_census(qs):
+    """Prefetch everything that the census displays about each cage.
+
+    qs : a queryset of Cage
+
+    Returns: the same queryset with prefetch_related and select_related
+    """
+    # I used to also prefetch_related on mouse_set__genotype but this
+    # stopped working
+    return qs.prefetch_related('mouse_set').\
+        prefetch_related('specialrequest_set').\
+        prefetch_related('specialrequest_set__requester').\
+        prefetch_related('specialrequest_set__requestee').\
+        prefetch_related('mouse_set__litter').\
+        prefetch_related('mouse_set__user').\
+        prefetch_related('litter__mouse_set').\
+        prefetch_related('litter__father__mousegene_set').\
+        prefetch_related('litter__mother__mousegene_set').\
+        prefetch_related('litter__father__mousegene_set__gene_name').\
+        prefetch_related('litter__mother__mousegene_set__gene_name').\
+        prefetch_related('mouse_set__mousegene_set').\
+        prefetch_related('mouse_set__mousegene_set__gene_name').\
+        select_related('litter', 'litter__father', 'litter__mother',
+            'litter__mother__cage', # for contains_mother_of_this_litter
+            'proprietor', 'litter__proprietor')
+
+def mark_rows_stale(rows):
+    """Mark these census rows as needing to be recomputed.
+
+    rows : a queryset of CageCensusRow
+
+    Their version is incremented too, see refresh_census_rows.
+    """
+    rows.update(stale=True, version=F('version') + 1)
+
+def mark_cages_stale(cage_ids):
+    """Mark the census rows of these cages as needing to be recomputed"""
+    cage_ids = [cage_id for cage_id in cage_ids if cage_id is not None]
+    if len(cage_ids) == 0:
+        return
+    mark_rows_stale(CageCensusRow.objects.filter(cage_id__in=cage_ids))
+
+def mark_mice_stale(mouse_ids, cage_ids=()):
+    """Mark the census rows of every cage that displays these mice.
+
+    A mouse is displayed in the cage it lives in, and its litter and its
+    genes are displayed in the breeding cage it was born in and in every
+    breeding cage in which it is a parent.
+
+    mouse_ids : ids of the Mouse that changed
+    cage_ids : ids of any additional Cage to mark, for instance the cage
+        that a mouse was just moved out of or deleted from
+
+    This is done with a single UPDATE query.
+    """
+    mouse_ids = [mouse_id for mouse_id in mouse_ids if mouse_id is not None]
+    cage_ids = [cage_id for cage_id in cage_ids if cage_id is not None]
+    if len(mouse_ids) == 0 and len(cage_ids) == 0:
+        return
+
+    mark_rows_stale(CageCensusRow.objects.filter(
+        Q(cage_id__in=cage_ids) |
+        Q(cage__mouse__in=mouse_ids) |
+        Q(cage__litter__mouse__in=mouse_ids) |
+        Q(cage__litter__father__in=mouse_ids) |
+        Q(cage__litter__mother__in=mouse_ids)
+    ))
+
+def compute_census_row(cage, today=None):
+    """Compute (but do not save) the CageCensusRow for a cage.
+
+    cage : a Cage, ideally from a queryset passed through prefetch_for_census
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    return CageCensusRow(
+        cage=cage,
+        stale=False,
+        computed_on=today,
+        type_of_cage=cage.type_of_cage,
+        relevant_genesets=[list(geneset) for geneset in cage.relevant_genesets],
+        rendered_html=render_to_string(
+            'colony/census_cage_rows.html', {'cage': cage}),
+    )
+
+def refresh_census_rows(cage_ids, today=None):
+    """Recompute and save the census rows for these cages.
+
+    The version of each existing row is read before recomputing it, and
+    the row is only overwritten if its version has not changed since.
+    Otherwise it was marked stale while being recomputed, so the new row
+    may already be out of date, and the existing row is left stale.
+
+    Returns: dict of the new CageCensusRow, keyed by cage id
+    """
+    if today is None:
+        today = datetime.date.today()
+
+    cage_ids = list(cage_ids)
+    if len(cage_ids) == 0:
+        return {}
+
+    # Read the versions before reading anything that the rows display
+    version_of = dict(CageCensusRow.objects.filter(
+        cage_id__in=cage_ids).values_list('cage_id', 'version'))
+
+    # Compute every row from one set of prefetched queries
+    cages = prefetch_for_census(Cage.objects.filter(pk__in=cage_ids))
+    rows = [compute_census_row(cage, today) for cage in cages]
+
+    # Insert the new rows, unless another request just inserted them
+    CageCensusRow.objects.bulk_create(
+        [row for row in rows if row.cage_id not in version_of],
+        ignore_conflicts=True,
+    )
+
+    # Overwrite the existing rows only if they were not marked stale since
+    cage_ids_by_version = {}
+    for cage_id, version in version_of.items():
+        cage_ids_by_version.setdefault(version, []).append(cage_id)
+    if len(cage_ids_by_version) > 0:
+        CageCensusRow.objects.filter(functools.reduce(operator.or_, [
+            Q(cage_id__in=version_cage_ids, version=version)
+            for version, version_cage_ids in cage_ids_by_version.items()
+        ])).bulk_update(
+            [row for row in rows if row.cage_id in version_of],
+            ['stale', 'computed_on', 'type_of_cage', 'relevant_genesets',
+                'rendered_html'],
+        )
+
+    return {row.cage_id: row for row in rows}
+
+def cages_with_census_rows(qs):
+    """Evaluate a Cage queryset with an up to date census_row on each cage.
+
+    The snapshots are read with the cages in a single query. Only the
+    cages whose row is missing, stale, or from a previous day are
+    recomputed.
+
+    qs : a queryset of Cage, already filtered and ordered
+
+    Returns: list of Cage
+        Each has a current CageCensusRow in cage.census_row
+    """
+    today = datetime.date.today()
+    cages = list(qs.select_related('census_row'))
+
+    # Find the cages whose row needs to be recomputed
+    outdated_ids = []
+    for cage in cages:
+        try:
+            row = cage.census_row
+        except CageCensusRow.DoesNotExist:
+            row = None
+
+        if row is None or not row.is_current(today):
+            outdated_ids.append(cage.pk)
+
+    # Recompute them all at once and attach them
+    new_rows = refresh_census_rows(outdated_ids, today)
+    for cage in cages:
+        if cage.pk in new_rows:
+            cage.census_row = new_rows[cage.pk]
+
+    return cages
+
+def group_cages_by_geneset(cages, genesets_of=None):
+    """Group cages by each of their relevant genesets.
+
+    Each cage's genesets are computed only once, and the groups are
+    collected in a dict, so this is linear in the number of cages. A cage
+    that contains a mixture of genesets is listed under each of them.
+
+    cages : iterable of Cage
+    genesets_of : function that takes a Cage and returns a list of its
+        genesets, each a sequence of gene names. If None, the
+        relevant_genesets property is used. The census view passes a
+        function that reads them from the CageCensusRow instead.
+
+    Returns: list of dicts, sorted by first gene and then number of genes
+        Each dict has keys:
+            'geneset': tuple of gene names
+            'dname': display name for the geneset
+            'cage_l': list of cages with that geneset, in the same order
+                as `cages`
+    """
+    if genesets_of is None:
+        genesets_of = lambda cage: cage.relevant_genesets
+
+    # Iterate once over cages and group by geneset
+    # Genesets are stored in order of first appearance
+    geneset2cage_l = {}
+    for cage in cages:
+        for geneset in genesets_of(cage):
+            geneset2cage_l.setdefault(tuple(geneset), []).append(cage)
+
+    # Sort by first gene, then number of genes
+    sorted_genesets = sorted(geneset2cage_l.keys(),
+        key=lambda v: (v[0] if len(v) > 0 else '', len(v)))
+
+    return [{
+        'geneset': geneset,
+        'dname': (' x '.join(geneset)) if len(geneset) > 0 else 'WT',
+        'cage_l': geneset2cage_l[geneset],
+        } for geneset in sorted_genesets]
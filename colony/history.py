@@ -0,0 +1,272 @@
+"""Functions for building the feed of recent changes in the records view.
+
+The feed shows the most recent historical records of several models, and
+what changed in each record since the previous version of the same object.
+Rather than querying for the previous version of each record separately,
+the id of the previous version is annotated onto each page of records, and
+all the previous versions of one model are fetched with a single query.
+"""
+from __future__ import unicode_literals
+
+import functools
+import heapq
+from itertools import islice
+
+from django.db.models import CharField, F, OuterRef, Q, Subquery, Value
+from django.utils.dateparse import parse_datetime
+
+from .models import Mouse, Cage, Litter, SpecialRequest
+
+
+# The models shown in the feed, in the order that simultaneous changes are
+# listed. Each is (label, model, path to the name of the proprietor, path to
+# the name to display)
+FEED_MODELS = [
+    ('Mouse', Mouse, 'cage__proprietor__name', 'name'),
+    ('Cage', Cage, 'proprietor__name', 'name'),
+    ('Litter', Litter, 'proprietor__name', 'breeding_cage__name'),
+    ('SpecialRequest', SpecialRequest, 'cage__proprietor__name',
+        'cage__name'),
+]
+FEED_LABELS = [label for label, model, proprietor_path, name_path
+    in FEED_MODELS]
+
+@functools.lru_cache(maxsize=None)
+def diff_fields(history_model):
+    """The fields compared between two versions of a historical model.
+
+    These are the same fields that diff_against compares: the editable
+    fields of the tracked model, which is also what model_to_dict returns.
+
+    Returns: list of tuples (name, attname, is_relation)
+    """
+    editable = set(field.name
+        for field in history_model.instance_type._meta.concrete_fields
+        if field.editable)
+
+    # Keep the order of the historical model, which lists foreign keys last
+    return [(field.name, field.attname, field.is_relation)
+        for field in history_model._meta.fields if field.name in editable]
+
+def related_fields(history_model):
+    """Names of the foreign keys of a historical model, for select_related"""
+    return [name for name, attname, is_relation in diff_fields(history_model)
+        if is_relation]
+
+def feed_querysets(proprietor=None):
+    """Querysets of the historical records to show in the feed.
+
+    Each record is annotated with:
+        feed_model : the label of its model in FEED_MODELS
+        feed_name : the name to display for the object
+        prev_history_id : the history_id of the previous version of the same
+            object, or None if this is the first one
+
+    proprietor : if not None, only include records whose proprietor's name
+        contains this
+
+    Returns: list of querysets, in the order of FEED_MODELS
+    """
+    querysets = []
+    for label, model, proprietor_path, name_path in FEED_MODELS:
+        history_model = model.history.model
+        object_id = model._meta.pk.attname
+
+        # The most recent earlier record of the same object. Records with
+        # the same history_date, as from bulk_history_create, are ordered
+        # by history_id, the same as in feed_position
+        previous = history_model.objects.filter(
+            Q(history_date__lt=OuterRef('history_date')) |
+            Q(history_date=OuterRef('history_date'),
+                history_id__lt=OuterRef('history_id')),
+            **{object_id: OuterRef(object_id)}
+        ).order_by('-history_date', '-history_id').values('history_id')[:1]
+
+        qs = history_model.objects.annotate(
+            feed_model=Value(label, output_field=CharField()),
+            feed_name=F(name_path),
+            prev_history_id=Subquery(previous),
+        ).select_related('history_user', *related_fields(history_model))
+
+        if proprietor:
+            qs = qs.filter(**{proprietor_path + '__icontains': proprietor})
+
+        querysets.append(qs)
+
+    return querysets
+
+def feed_position(record):
+    """The position of a record in the feed, for sorting and paging.
+
+    Records are sorted newest first by history_date, then in the order of
+    FEED_MODELS, then newest first by history_id. Every record has a
+    different position, so records with the same history_date are never
+    skipped or repeated across pages.
+
+    record : historical record annotated with feed_model, as from
+        feed_querysets
+
+    Returns: tuple (history_date, feed_model, history_id)
+        This is the cursor to pass as `before` to get the next page
+    """
+    return (record.history_date, record.feed_model, record.history_id)
+
+def parse_feed_position(history_date, feed_model=None, history_id=None):
+    """Parse a position in the feed from the parameters of a URL.
+
+    history_date : string in ISO format
+    feed_model, history_id : strings, both or neither
+
+    Returns: tuple (history_date, feed_model, history_id), see feed_position
+        feed_model and history_id are None if they were not given
+
+    Raises ValueError if any of them is not valid.
+    """
+    # parse_datetime returns None if the format is wrong, and raises
+    # ValueError if it is right but the date is impossible
+    parsed_date = parse_datetime(history_date)
+    if parsed_date is None:
+        raise ValueError('invalid date: {}'.format(history_date))
+
+    if feed_model is None and history_id is None:
+        return (parsed_date, None, None)
+    if feed_model not in FEED_LABELS:
+        raise ValueError('invalid model: {}'.format(feed_model))
+    return (parsed_date, feed_model, int(history_id))
+
+def _sort_key(position):
+    """Key that sorts feed positions in reverse order of the feed"""
+    history_date, feed_model, history_id = position
+    return (history_date, -FEED_LABELS.index(feed_model), history_id)
+
+def merge_history_feed(querysets, n_records, before=None):
+    """Return the most recent records from several historical models.
+
+    Each queryset is sorted and limited in the database, so at most
+    n_records are read from each. These are then merged in the order
+    described by feed_position.
+
+    querysets : list of querysets of historical records, in the order of
+        FEED_MODELS
+    n_records : number of records to return
+    before : tuple (history_date, feed_model, history_id) or None
+        If not None, only records after this position in the feed are
+        returned. Pass the feed_position of the last record of the
+        previous page to get the next page. If feed_model and history_id
+        are None, all records strictly before history_date are returned.
+
+    Returns: list of historical records
+        The most recent n_records from all querysets, newest first
+    """
+    feeds = []
+    for label, qs in zip(FEED_LABELS, querysets):
+        if before is not None:
+            qs = qs.filter(records_before(label, *before))
+        feeds.append(qs.order_by('-history_date', '-history_id')[:n_records])
+
+    return list(islice(heapq.merge(*feeds,
+        key=lambda record: _sort_key(feed_position(record)), reverse=True),
+        n_records))
+
+def records_before(label, history_date, feed_model, history_id):
+    """Q for the records of one model after a position in the feed.
+
+    label : the label in FEED_MODELS of the model being filtered
+    history_date, feed_model, history_id : the position, see feed_position
+
+    Returns: Q
+    """
+    earlier = Q(history_date__lt=history_date)
+    if feed_model is None:
+        return earlier
+
+    # Simultaneous records are listed in the order of FEED_MODELS
+    rank = FEED_LABELS.index(label)
+    before_rank = FEED_LABELS.index(feed_model)
+    if rank < before_rank:
+        return earlier
+    elif rank > before_rank:
+        return Q(history_date__lte=history_date)
+    return earlier | Q(history_date=history_date, history_id__lt=history_id)
+
+def previous_records(records):
+    """Fetch the previous version of each of these historical records.
+
+    records : list of historical records annotated with prev_history_id,
+        as from feed_querysets
+
+    Returns: dict
+        Keys are the historical model and history_id of the previous
+        versions, and values are the historical records. This takes one
+        query per historical model.
+    """
+    # Group the ids of the previous versions by model
+    ids_by_model = {}
+    for record in records:
+        if record.prev_history_id is not None:
+            ids_by_model.setdefault(type(record), []).append(
+                record.prev_history_id)
+
+    res = {}
+    for history_model, history_ids in ids_by_model.items():
+        for record in history_model.objects.filter(
+                history_id__in=history_ids).select_related(
+                *related_fields(history_model)):
+            res[(history_model, record.history_id)] = record
+    return res
+
+def diff_records(old_record, new_record):
+    """Find which fields differ between two versions of the same object.
+
+    Fields are compared the same way as diff_against, by their raw values,
+    so comparing foreign keys does not need to fetch the related objects.
+    For display, foreign keys are shown as the related object if it was
+    fetched with select_related, and otherwise as the raw id.
+
+    Returns: list of dicts, each with keys
+        field : name of the field that was changed
+        old : previous value
+        new : new value
+        type : 'addition', 'removal', or 'change'
+    """
+    changes = []
+    for name, attname, is_relation in diff_fields(type(new_record)):
+        old_field_value = getattr(old_record, attname)
+        new_field_value = getattr(new_record, attname)
+
+        # Determine if this was added, deleted, changed, or nothing
+        if old_field_value is None and new_field_value is not None:
+            change_type = 'addition'
+        elif new_field_value is None and old_field_value is not None:
+            change_type = 'removal'
+        elif old_field_value != new_field_value:
+            change_type = 'change'
+        else:
+            # no change made to this field
+            continue
+
+        # Display related objects instead of their ids
+        if is_relation:
+            old_field_value = display_related(old_record, name, attname)
+            new_field_value = display_related(new_record, name, attname)
+
+        changes.append({
+            'field': name,
+            'old': old_field_value,
+            'new': new_field_value,
+            'type': change_type,
+        })
+
+    return changes
+
+def display_related(record, name, attname):
+    """The object that a foreign key of a record points to, if available.
+
+    Returns None if the key is None. Returns the raw id if the related
+    object no longer exists.
+    """
+    value = getattr(record, attname)
+    if value is None:
+        return None
+    related = getattr(record, name)
+    return value if related is None else related
@@ -0,0 +1,25 @@
+"""Recompute the stored genotypes of every mouse and litter.
+
+Mouse.genotype_cache, Mouse.strain_cache, and Litter.target_genotype are
+normally kept up to date by the signal handlers in colony.signals. Run
+this after changing the data in a way that bypasses them, such as a raw
+SQL fix or a bulk import:
+    python manage.py rebuild_genotype_caches
+"""
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from colony.models import (Mouse, Litter, refresh_mouse_caches,
+    refresh_target_genotypes)
+
+
+class Command(BaseCommand):
+    help = 'Recompute the stored genotype and strain of every mouse and litter'
+
+    def handle(self, *args, **options):
+        n_mice = refresh_mouse_caches(Mouse.objects.all())
+        n_litters = refresh_target_genotypes(Litter.objects.all())
+
+        self.stdout.write('Updated {} mice and {} litters'.format(
+            n_mice, n_litters))
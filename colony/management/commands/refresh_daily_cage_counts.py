@@ -0,0 +1,43 @@
+"""Store the daily cage and mouse counts in DailyCageCount.
+
+Run this nightly, for instance with the Heroku Scheduler:
+    python manage.py refresh_daily_cage_counts
+
+Each run only counts the days since the previous run. The first run
+backfills every day since the first historical record.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+import colony.occupancy
+
+
+class Command(BaseCommand):
+    help = 'Count cages and mice for each day since the last refresh'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--until',
+            help='last date to count, as YYYY-MM-DD (default: today)')
+        parser.add_argument('--rebuild', action='store_true',
+            help='delete the stored counts and backfill them from scratch')
+
+    def handle(self, *args, **options):
+        until = None
+        if options['until']:
+            try:
+                until = datetime.date.fromisoformat(options['until'])
+            except ValueError:
+                raise CommandError(
+                    'cannot parse date: {}'.format(options['until']))
+
+        dates = colony.occupancy.refresh_daily_cage_counts(
+            until=until, rebuild=options['rebuild'])
+
+        if len(dates) == 0:
+            self.stdout.write('Already up to date')
+        else:
+            self.stdout.write('Counted {} days from {} to {}'.format(
+                len(dates), dates[0], dates[-1]))
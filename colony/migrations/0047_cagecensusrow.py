@@ -0,0 +1,25 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:16
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0046_historicalmouse_toe_clipped_mouse_toe_clipped'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CageCensusRow',
+            fields=[
+                ('cage', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='census_row', serialize=False, to='colony.cage')),
+                ('stale', models.BooleanField(db_index=True, default=True)),
+                ('computed_on', models.DateField(blank=True, null=True)),
+                ('type_of_cage', models.CharField(blank=True, max_length=30)),
+                ('relevant_genesets', models.JSONField(blank=True, default=list)),
+                ('rendered_html', models.TextField(blank=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0047_cagecensusrow'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyCageCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('location', models.IntegerField()),
+                ('n_cages', models.IntegerField(default=0)),
+                ('n_mice', models.IntegerField(default=0)),
+                ('proprietor', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='colony.person')),
+            ],
+            options={
+                'ordering': ['date', 'proprietor', 'location'],
+                'unique_together': {('date', 'proprietor', 'location')},
+            },
+        ),
+    ]
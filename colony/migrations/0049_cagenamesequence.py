@@ -0,0 +1,21 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0048_dailycagecount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CageNameSequence',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('series_number', models.IntegerField(unique=True)),
+                ('last_number', models.IntegerField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:29
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0049_cagenamesequence'),
+    ]
+
+    operations = [
+        # Needed for gin_trgm_ops and trigram_similar
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name='mouse',
+            index=models.Index(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Lower('name'), name='text_pattern_ops'), name='colony_mouse_name_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mouse',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass('name', name='gin_trgm_ops'), name='colony_mouse_name_trgm_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='mouse',
+            index=models.Index(condition=models.Q(('sack_date__isnull', True)), fields=['sex'], name='colony_mouse_unsacked_sex_idx'),
+        ),
+    ]
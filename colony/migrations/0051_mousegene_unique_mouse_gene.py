@@ -0,0 +1,34 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:33
+
+from django.db import migrations, models
+
+
+def delete_duplicate_mousegenes(apps, schema_editor):
+    """Keep only the oldest MouseGene for each mouse and gene"""
+    MouseGene = apps.get_model('colony', 'MouseGene')
+    
+    seen = set()
+    duplicate_ids = []
+    for pk, mouse_id, gene_id in MouseGene.objects.order_by('pk').values_list(
+            'pk', 'mouse_name_id', 'gene_name_id'):
+        if (mouse_id, gene_id) in seen:
+            duplicate_ids.append(pk)
+        else:
+            seen.add((mouse_id, gene_id))
+    
+    MouseGene.objects.filter(pk__in=duplicate_ids).delete()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0050_mouse_name_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_mousegenes,
+            migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='mousegene',
+            constraint=models.UniqueConstraint(fields=('mouse_name', 'gene_name'), name='colony_mousegene_unique_mouse_gene'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:39
+
+import autoslug.fields
+import colony.models
+import django.contrib.postgres.indexes
+from django.db import migrations
+import django.db.models.functions.text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0051_mousegene_unique_mouse_gene'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='historicallitter',
+            name='target_genotype',
+            field=autoslug.fields.AutoSlugField(editable=False, populate_from=colony.models.slug_target_genotype, slugify=colony.models.my_slugify),
+        ),
+        migrations.AlterField(
+            model_name='litter',
+            name='target_genotype',
+            field=autoslug.fields.AutoSlugField(editable=False, populate_from=colony.models.slug_target_genotype, slugify=colony.models.my_slugify),
+        ),
+        migrations.AddIndex(
+            model_name='litter',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('target_genotype'), name='gin_trgm_ops'), name='colony_litter_target_trgm_idx'),
+        ),
+    ]
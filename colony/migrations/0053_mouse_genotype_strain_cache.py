@@ -0,0 +1,69 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:42
+
+from django.db import migrations, models
+
+
+# Copies of colony.models.format_genotype and format_strain_description as
+# they were when this migration was written, so that later changes to the
+# app code do not change what this migration does
+
+def format_strain_description(mouse_strains):
+    """The strain names in alphabetical order, joined by ':'"""
+    mouse_strains = sorted(mouse_strains,
+        key=lambda mouse_strain: mouse_strain.strain_key.name)
+    if len(mouse_strains) == 0:
+        return 'unknown_strain'
+    
+    strain_string = ':'.join(
+        mouse_strain.strain_key.name for mouse_strain in mouse_strains)
+    if any(mouse_strain.weight != 1 for mouse_strain in mouse_strains):
+        strain_string += ' (bad weight)'
+    return strain_string
+
+def format_genotype(pure_wild_type, mouse_genes):
+    """The genes other than -/- with their zygosity, joined by '; '"""
+    mouse_genes = list(mouse_genes)
+    if len(mouse_genes) == 0 and pure_wild_type:
+        return 'pure WT'
+    
+    res_l = ['%s(%s)' % (mg.gene_name.name, mg.zygosity)
+        for mg in mouse_genes if mg.zygosity != '-/-']
+    if len(res_l) == 0:
+        return 'negative'
+    return '; '.join(res_l)
+
+def populate_mouse_caches(apps, schema_editor):
+    """Fill in genotype_cache and strain_cache of every existing mouse"""
+    Mouse = apps.get_model('colony', 'Mouse')
+
+    mice = list(Mouse.objects.prefetch_related(
+        'mousegene_set__gene_name', 'mousestrain_set__strain_key'))
+    for mouse in mice:
+        mouse.genotype_cache = format_genotype(
+            mouse.pure_wild_type, mouse.mousegene_set.all())
+        mouse.strain_cache = format_strain_description(
+            mouse.mousestrain_set.all())
+
+    Mouse.objects.bulk_update(mice, ['genotype_cache', 'strain_cache'],
+        batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0052_litter_target_genotype_on_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mouse',
+            name='genotype_cache',
+            field=models.TextField(blank=True, db_index=True, editable=False, verbose_name='genotype'),
+        ),
+        migrations.AddField(
+            model_name='mouse',
+            name='strain_cache',
+            field=models.TextField(blank=True, db_index=True, editable=False, verbose_name='strain'),
+        ),
+        migrations.RunPython(populate_mouse_caches,
+            migrations.RunPython.noop),
+    ]
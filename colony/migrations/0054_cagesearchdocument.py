@@ -0,0 +1,62 @@
+# Generated by Django 4.1.10 on 2026-10-18 17:47
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.functions.text
+
+
+def cage_search_document(cage):
+    """The text to search for a cage, as colony.search builds it.
+
+    A copy, so that later changes to the app code do not change what this
+    migration does.
+    """
+    mice = list(cage.mouse_set.all())
+    gene_names = set()
+    strain_names = set()
+    for mouse in mice:
+        for mg in mouse.mousegene_set.all():
+            gene_names.add(mg.gene_name.name)
+        for ms in mouse.mousestrain_set.all():
+            strain_names.add(ms.strain_key.name)
+
+    lines = ([cage.name, cage.sticker, cage.dar_id] +
+        sorted(mouse.name for mouse in mice) +
+        sorted(gene_names) + sorted(strain_names))
+    return '\n'.join(line for line in lines if line)
+
+def populate_search_documents(apps, schema_editor):
+    """Build the search document of every existing cage"""
+    Cage = apps.get_model('colony', 'Cage')
+    CageSearchDocument = apps.get_model('colony', 'CageSearchDocument')
+    
+    cages = Cage.objects.prefetch_related(
+        'mouse_set__mousegene_set__gene_name',
+        'mouse_set__mousestrain_set__strain_key')
+    CageSearchDocument.objects.bulk_create([
+        CageSearchDocument(cage=cage, document=cage_search_document(cage))
+        for cage in cages
+    ], batch_size=500)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0053_mouse_genotype_strain_cache'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CageSearchDocument',
+            fields=[
+                ('cage', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='colony.cage')),
+                ('document', models.TextField(blank=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='cagesearchdocument',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('document'), name='gin_trgm_ops'), name='colony_cagesearch_trgm_idx'),
+        ),
+        migrations.RunPython(populate_search_documents,
+            migrations.RunPython.noop),
+    ]
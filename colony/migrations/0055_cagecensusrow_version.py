@@ -0,0 +1,18 @@
+# Generated by Django 4.1.10 on 2026-10-18 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('colony', '0054_cagesearchdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cagecensusrow',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -18,16 +18,21 @@ from builtins import str
 from builtins import zip
 from past.utils import old_div
 from builtins import object
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q, Window
+from django.db.models.functions import Lag, Lower, Upper
+from django.contrib.postgres.indexes import GinIndex, OpClass
 import datetime
 from django.urls import reverse
 from django.urls.exceptions import NoReverseMatch
 from simple_history.models import HistoricalRecords
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import escape
 from django.contrib.auth.models import User
 from django.utils.safestring import mark_safe
 from autoslug import AutoSlugField
+from autoslug.utils import crop_slug
 
 def strip_alpha(cage_name):
     """Keep only digits from cage name
@@ -56,13 +61,11 @@ def strip_alpha(cage_name):
     else:
         return int(res)
 
-def generate_cage_name(series_number):
-    """Returns the next cage name for this user.
+def max_cage_number(series_number):
+    """Returns the highest existing cage number in this series, or None.
     
-    series_number : series number to generate the cage number
-    
-    Finds all existing cage names and chooses one number higher.
-    Returns: the new cage name as a string
+    This reads every cage name, so it is only used to start the
+    CageNameSequence of each series.
     """
     # Find all cage numbers in this series
     all_cage_names = Cage.objects.all().values_list('name', flat=True)
@@ -81,19 +84,57 @@ def generate_cage_name(series_number):
     #~ cage_numbers = map(strip_alpha, cage_names)
     #~ cage_numbers = filter(lambda num: num is not None, cage_numbers)
     
-    # Generate a new cage number that is 1 higher
     if len(my_cage_numbers) == 0:
-        target_cage = series_number * 1000 + 1
-    else:
-        target_cage = max(my_cage_numbers) + 1
-    #~ target_cage_name = '%04d' % target_cage
-    target_cage_name = str(target_cage)
+        return None
+    return max(my_cage_numbers)
+
+def generate_cage_name(series_number):
+    """Returns the next cage name for this user.
     
-    # Error check
-    if not target_cage_name.startswith(str(series_number)):
-        raise ValueError("cannot generate new cage name, series full?")
-    if Cage.objects.filter(name=target_cage_name).count() > 0:
-        raise ValueError("cannot generate new unique cage name")
+    series_number : series number to generate the cage number
+    
+    The last number used in each series is stored in CageNameSequence.
+    The row for this series is locked with SELECT ... FOR UPDATE while
+    it is incremented, so concurrent requests never get the same name.
+    The first time a series is used, it starts one higher than the
+    highest existing cage number in that series. Numbers already taken
+    by a manually named cage are skipped.
+    
+    Returns: the new cage name as a string
+    """
+    with transaction.atomic():
+        # Lock the sequence until the end of this transaction
+        sequence = CageNameSequence.objects.select_for_update().filter(
+            series_number=series_number).first()
+        
+        if sequence is None:
+            # Start the sequence, the only time every cage name is read
+            try:
+                with transaction.atomic():
+                    CageNameSequence.objects.create(
+                        series_number=series_number,
+                        last_number=(max_cage_number(series_number) or
+                            series_number * 1000),
+                    )
+            except IntegrityError:
+                # Another request started it first
+                pass
+            sequence = CageNameSequence.objects.select_for_update().get(
+                series_number=series_number)
+        
+        # Generate a new cage number that is 1 higher
+        # Skip any that were already used by hand
+        target_cage = sequence.last_number + 1
+        while Cage.objects.filter(name=str(target_cage)).exists():
+            target_cage += 1
+        target_cage_name = str(target_cage)
+        
+        # Error check
+        if target_cage // 1000 != series_number:
+            raise ValueError("cannot generate new cage name, series full?")
+        
+        sequence.last_number = target_cage
+        sequence.save(update_fields=['last_number'])
     
     return target_cage_name
 
@@ -184,6 +225,172 @@ def my_slugify(s):
     """Don't apply any prettification to the slug, such as removing +"""
     return s
 
+def compute_target_genotype(litter):
+    """Compute the value that Litter.target_genotype should have.
+    
+    This is slug_target_genotype, slugified and cropped to the length of
+    the field, the same way that AutoSlugField populates it.
+    """
+    field = Litter._meta.get_field('target_genotype')
+    return crop_slug(field, field.slugify(slug_target_genotype(litter)))
+
+def format_strain_description(mouse_strains):
+    """Return a string describing the strain of a mouse.
+    
+    mouse_strains : iterable of the MouseStrain of the mouse
+    
+    If there are none:
+        returns 'unknown_strain'
+    Otherwise:
+        returns the strain names in alphabetical order, joined by ':'
+        If any weight is not 1, ' (bad weight)' is appended.
+    """
+    # This is a list so that prefetched MouseStrain are used
+    mouse_strain_set = list(mouse_strains)
+    
+    # This flag is set for weight problems
+    weight_is_wrong = False
+    
+    # If none, then return strain unknown
+    if len(mouse_strain_set) == 0:
+        return 'unknown_strain'
+    
+    elif len(mouse_strain_set) == 1:
+        # Consists of only one strain
+        only_mouse_strain = mouse_strain_set[0]
+        
+        # The weight should be exactly 1
+        if only_mouse_strain.weight != 1:
+            weight_is_wrong = True
+        
+        # Return the name of the only strain
+        if weight_is_wrong:
+            return '{} (bad weight)'.format(only_mouse_strain.strain_key.name)
+        else:
+            return only_mouse_strain.strain_key.name
+    
+    else:
+        # Multiple strains
+        strain_names = []
+        
+        # Iterate over strains, in alphabetical order
+        for mouse_strain in sorted(mouse_strain_set,
+                key=lambda mouse_strain: mouse_strain.strain_key.name):
+            # Save name
+            strain_names.append(mouse_strain.strain_key.name)
+            
+            # Check weight is 1
+            if mouse_strain.weight != 1:
+                weight_is_wrong = True
+        
+        # Form the string
+        strain_string = ':'.join(strain_names)
+        if weight_is_wrong:
+            strain_string += ' (bad weight)'
+        
+        return strain_string
+
+def format_genotype(pure_wild_type, mouse_genes):
+    """Return a genotype string by concatenating the MouseGene of a mouse
+    
+    pure_wild_type : the pure_wild_type of the mouse
+    mouse_genes : iterable of the MouseGene of the mouse, in order
+    
+    If wild_type:
+        returns 'pure WT'
+    Elif the mouse has no mousegenes, or only -/- mousegenes:
+        returns 'negative'
+    Otherwise:
+        returns a string of the format 
+            "GENE1(ZYGOSITY1); GENE2(ZYGOSITY2)..."
+        Genes with zygosity -/- are not included in this string.
+    """
+    mouse_genes = list(mouse_genes)
+    
+    # If it's wild type, it shouldn't have any genes
+    if len(mouse_genes) == 0 and pure_wild_type:
+        return 'pure WT'
+    
+    # Get all MouseGenes other than -/-
+    res_l = []
+    for mg in mouse_genes:
+        if mg.zygosity == MouseGene.zygosity_nn:
+            continue
+        res_l.append('%s(%s)' % (mg.gene_name.name, mg.zygosity))
+    
+    if len(res_l) == 0:
+        # It has no mousegenes, or only -/- mouse genes
+        # Render as 'negative'. Avoid confusion with 'WT'
+        # Also don't include the 'pure' because 'pure negative'
+        # is confusing.            
+        return 'negative'
+    else:
+        # Join remaining mousegenes
+        return '; '.join(res_l)
+
+def refresh_mouse_caches(mice, batch_size=500):
+    """Recompute genotype_cache and strain_cache of these mice.
+    
+    The signal handlers in colony.signals call this whenever a MouseGene
+    or MouseStrain changes, or a Gene or Strain is renamed. Changes to
+    pure_wild_type are handled when the mouse is saved.
+    
+    mice : queryset of Mouse
+    batch_size : number of mice to update per query
+    
+    The genes and strains are prefetched, and only the mice whose values
+    changed are written, without sending signals or adding history.
+    
+    Returns: number of mice that changed
+    """
+    mice = mice.prefetch_related(
+        'mousegene_set__gene_name', 'mousestrain_set__strain_key')
+    
+    changed_mice = []
+    for mouse in mice:
+        genotype = mouse.genotype
+        strain = mouse.strain_description
+        if mouse.genotype_cache != genotype or mouse.strain_cache != strain:
+            mouse.genotype_cache = genotype
+            mouse.strain_cache = strain
+            changed_mice.append(mouse)
+    
+    Mouse.objects.bulk_update(changed_mice, ['genotype_cache', 'strain_cache'],
+        batch_size=batch_size)
+    return len(changed_mice)
+
+def refresh_target_genotypes(litters):
+    """Recompute target_genotype of these litters and save any that changed.
+    
+    Litter.target_genotype is only computed when a litter is created or
+    its parents change. The signal handlers in colony.signals call this
+    when anything else that it depends on changes: the genes and
+    pure_wild_type of either parent, the names of genes, and whether the
+    breeding cage is defunct.
+    
+    litters : queryset of Litter
+    
+    The parents' genes are prefetched, and the changed litters are written
+    with one UPDATE query, without sending signals or adding history.
+    
+    Returns: number of litters that changed
+    """
+    litters = litters.select_related(
+        'breeding_cage', 'father', 'mother').prefetch_related(
+        'father__mousegene_set__gene_name',
+        'mother__mousegene_set__gene_name',
+    )
+    
+    changed_litters = []
+    for litter in litters:
+        target_genotype = compute_target_genotype(litter)
+        if litter.target_genotype != target_genotype:
+            litter.target_genotype = target_genotype
+            changed_litters.append(litter)
+    
+    Litter.objects.bulk_update(changed_litters, ['target_genotype'])
+    return len(changed_litters)
+
 def have_same_single_gene(mouse1, mouse2):
     """Returns True if mouse1 and mouse2 have the same single MouseGene
     
@@ -314,10 +521,13 @@ class Cage(models.Model):
     class Meta(object):
         ordering = ['name']
     
-    @property
+    @cached_property
     def relevant_genesets(self):
         """The relevant genes for the colony view
         
+        This is computed once per instance, because it is used several
+        times for each cage, for instance by printable_relevant_genesets.
+        
         If it's a breeding cage (litter is defined and unweaned), then 
         the result is a list with one item: set of all mousegenes from 
         either parent.
@@ -508,8 +718,9 @@ class Cage(models.Model):
     def infos(self):
         """Return list of all mice in this cage with additional info on each"""
         # Get info from each contained mouse and prepend "pup" to pups
+        # Mice are ordered by name by default, and this uses prefetched mice
         info_l = []
-        for mouse in self.mouse_set.order_by('name').all():
+        for mouse in self.mouse_set.all():
             m_info = mouse.info()
             if mouse.still_in_breeding_cage:
                 m_info = 'pup ' + m_info
@@ -611,6 +822,16 @@ class Genotype(models.Model):
     def __str__(self):
         return self.name
 
+def progeny_q(mouse):
+    """Q object matching the children of `mouse`.
+    
+    `mouse` may be a Mouse or an expression such as OuterRef('pk').
+    """
+    return (
+        Q(litter__father=mouse) | Q(litter__mother=mouse) |
+        Q(manual_father=mouse) | Q(manual_mother=mouse)
+    )
+
 class Mouse(models.Model):
     """Model for a Mouse.
     
@@ -730,124 +951,108 @@ class Mouse(models.Model):
         on_delete=models.PROTECT,
         )
 
+    # Stored copies of the genotype and strain_description properties, so
+    # that they can be displayed, sorted, and filtered on without
+    # querying MouseGene and MouseStrain. These are kept up to date by
+    # refresh_mouse_caches, and are not tracked in the history.
+    genotype_cache = models.TextField('genotype', blank=True,
+        editable=False, db_index=True)
+    strain_cache = models.TextField('strain', blank=True,
+        editable=False, db_index=True)
+
     # track history with simple_history
-    history = HistoricalRecords()
+    history = HistoricalRecords(
+        excluded_fields=['genotype_cache', 'strain_cache'])
     
     # To always sort mice within a cage by name, eg in census view
     class Meta(object):
         ordering = ['name']
+        indexes = [
+            # For case-insensitive prefix search in the autocomplete views
+            # LOWER returns text, so this is text_pattern_ops
+            models.Index(OpClass(Lower('name'), name='text_pattern_ops'),
+                name='colony_mouse_name_lower_idx'),
+            
+            # For fuzzy search in the autocomplete views
+            GinIndex(OpClass('name', name='gin_trgm_ops'),
+                name='colony_mouse_name_trgm_idx'),
+            
+            # For choosing among living mice of one sex
+            models.Index(fields=['sex'],
+                condition=Q(sack_date__isnull=True),
+                name='colony_mouse_unsacked_sex_idx'),
+        ]
+    
+    # The fields whose saved values colony.signals needs before each save
+    TRACKED_FIELDS = ('cage_id', 'pure_wild_type')
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the saved values of TRACKED_FIELDS, if they were loaded.
+        
+        These are stored in _saved_values, so that the pre_save signal
+        handlers can tell what changed without querying the database.
+        """
+        instance = super(Mouse, cls).from_db(db, field_names, values)
+        instance._saved_values = dict(
+            (field_name, value) for field_name, value in zip(field_names, values)
+            if field_name in cls.TRACKED_FIELDS)
+        return instance
+    
+    def refresh_from_db(self, *args, **kwargs):
+        """Reload from the database, and forget the remembered values"""
+        super(Mouse, self).refresh_from_db(*args, **kwargs)
+        self._saved_values = {}
     
     @property
     def strain_description(self):
         """Return a string describing the strain from linked MouseStrain
         
-        
+        See format_strain_description. The stored copy is strain_cache.
         """
-        # Get all MouseStrain
-        mouse_strain_set = self.mousestrain_set.all()
-        
-        # This flag is set for weight problems
-        weight_is_wrong = False
-        
-        # If none, then return strain unknown
-        if len(mouse_strain_set) == 0:
-            return 'unknown_strain'
-        
-        elif len(mouse_strain_set) == 1:
-            # Consists of only one strain
-            only_mouse_strain = mouse_strain_set.first()
-            
-            # The weight should be exactly 1
-            if only_mouse_strain.weight != 1:
-                weight_is_wrong = True
-            
-            # Return the name of the only strain
-            if weight_is_wrong:
-                return '{} (bad weight)'.format(only_mouse_strain.strain_key.name)
-            else:
-                return only_mouse_strain.strain_key.name
-        
-        else:
-            # Multiple strains
-            strain_names = []
-            
-            # Iterate over strains, in alphabetical order
-            for mouse_strain in mouse_strain_set.order_by('strain_key__name').all():
-                # Save name
-                strain_names.append(mouse_strain.strain_key.name)
-                
-                # Check weight is 1
-                if mouse_strain.weight != 1:
-                    weight_is_wrong = True
-            
-            # Form the string
-            strain_string = ':'.join(strain_names)
-            if weight_is_wrong:
-                strain_string += ' (bad weight)'
-            
-            return strain_string
+        # Uses prefetched MouseStrain, if any
+        return format_strain_description(self.mousestrain_set.all())
     
     @property
     def genotype(self):
         """Return a genotype string by concatenating linked MouseGene objects
         
-        If wild_type:
-            returns 'pure WT'
-        Elif the mouse has no mousegenes, or only -/- mousegenes:
-            returns 'negative'
-        Otherwise:
-            returns a string of the format 
-                "GENE1(ZYGOSITY1); GENE2(ZYGOSITY2)..."
-            Genes with zygosity -/- are not included in this string.
+        See format_genotype. The stored copy is genotype_cache.
         """
-        # If it's wild type, it shouldn't have any genes
-        if not self.mousegene_set.exists() and self.pure_wild_type:
-            return 'pure WT'
-        
-        # Get all MouseGenes other than -/-
-        res_l = []
-        for mg in self.mousegene_set.all():
-            if mg.zygosity == MouseGene.zygosity_nn:
-                continue
-            res_l.append('%s(%s)' % (mg.gene_name, mg.zygosity))
-        
-        if len(res_l) == 0:
-            # It has no mousegenes, or only -/- mouse genes
-            # Render as 'negative'. Avoid confusion with 'WT'
-            # Also don't include the 'pure' because 'pure negative'
-            # is confusing.            
-            return 'negative'
-        else:
-            # Join remaining mousegenes
-            return '; '.join(res_l)
+        # Uses prefetched MouseGene, if any
+        return format_genotype(self.pure_wild_type, self.mousegene_set.all())
     
     def get_cage_history_list(self, only_cage_changes=True):
         """Return list of cage info at every historical timepoint.
         
-        The results are sorted from oldest to most recent.
+        The results are sorted from oldest to most recent. This takes
+        a single query, however long the history is.
         
         only_cage_changes : if True, then only return history items that
             have a different cage name than the immediately previous item
         
         Returns: list of dicts
-            Each dict has keys 'cage__name', 'history_date', 'history_user'
+            Each dict has keys 'cage__name', 'history_date',
+            'history_user_id', and 'history_user__username'
         """
-        # List of cages at all historical timepoints
-        h_list = self.history.order_by('history_date').all().values(
-            'cage__name', 'history_user_id', 'history_date')
+        # List of cages at all historical timepoints, each with the cage
+        # of the previous timepoint
+        h_list = self.history.order_by('history_date').annotate(
+            previous_cage__name=Window(
+                Lag('cage__name'), order_by=F('history_date').asc()),
+        ).values('cage__name', 'history_user_id', 'history_user__username',
+            'history_date', 'previous_cage__name')
         
         # Filter by only those that changed
-        if only_cage_changes:
-            current_cage = None
-            res = []
-            for hll in h_list:
-                if current_cage is None or hll['cage__name'] != current_cage:
-                    res.append(hll)
-                    current_cage = hll['cage__name']
-            return res
-        
-        else:
-            return h_list
+        # Django cannot filter on a window function, so this is done here
+        # Timepoints without a cage, and the ones after them, are always kept
+        res = []
+        for hll in h_list:
+            previous_cage = hll.pop('previous_cage__name')
+            if (not only_cage_changes or previous_cage is None or
+                    hll['cage__name'] != previous_cage):
+                res.append(hll)
+        return res
     
     def cage_history_string(self, only_cage_changes=True):
         """Returns a formatted string of the cage history for this mouse"""
@@ -855,9 +1060,8 @@ class Mouse(models.Model):
         res_l = []
         
         for hll in hl:
-            try:
-                username = User.objects.get(id=hll['history_user_id']).username
-            except User.DoesNotExist:
+            username = hll['history_user__username']
+            if username is None:
                 username = 'Unknown'
             
             res_l.append('%s Cage: %s  User: %s' % (
@@ -949,10 +1153,10 @@ class Mouse(models.Model):
             res += 'P%d ' % age
         
         # Always add strain
-        res += str(self.strain_description) + ' '
+        res += str(self.strain_cache) + ' '
         
         # Always add genotype
-        res += str(self.genotype)
+        res += str(self.genotype_cache)
         
         # Add user if we know it
         if self.user:
@@ -984,19 +1188,23 @@ class Mouse(models.Model):
 
     @property
     def progeny(self):
-        """Queries database to return all children of this mouse"""
-        # Check for mice that have self as a mother or as a father
-        # We don't want to want to assume based on self.sex because that
-        # may be '?' or set incorrectly
-        res1 = Mouse.objects.filter(litter__father=self)
-        res2 = Mouse.objects.filter(litter__mother=self)
-
-        if len(res1) > 0 and len(res2) > 0:
-            raise ValueError("mouse is both a father and a mother")
-        elif len(res1) == 0:
-            return res2
-        else:
-            return res1
+        """Queries database to return all children of this mouse
+        
+        Children are mice in a litter with this mouse as a parent, or with
+        this mouse as their manual mother or father. We don't want to assume
+        which parent this is based on self.sex because that may be '?' or
+        set incorrectly.
+        
+        Returns: a single queryset, with everything needed for info()
+            on each child already fetched
+        """
+        return Mouse.objects.filter(progeny_q(self)).select_related(
+            'litter', 'user')
+    
+    @property
+    def progeny_count(self):
+        """Returns the number of children of this mouse, in one query"""
+        return Mouse.objects.filter(progeny_q(self)).count()
     
     def age(self):
         if self.dob is None:
@@ -1011,7 +1219,8 @@ class Mouse(models.Model):
         This is used to prepend "pup" to the infos.
         """
         if self.litter:
-            return self.cage == self.litter.breeding_cage
+            # Compare ids to avoid fetching the cages
+            return self.cage_id == self.litter.breeding_cage_id
         else:
             return False
     
@@ -1161,6 +1370,12 @@ class MouseGene(models.Model):
     
     class Meta(object):
         ordering = ('gene_name__gene_type', 'gene_name__name',)
+        
+        # Each mouse has at most one zygosity for each gene
+        constraints = [
+            models.UniqueConstraint(fields=['mouse_name', 'gene_name'],
+                name='colony_mousegene_unique_mouse_gene'),
+        ]
 
 class Litter(models.Model):
     """Model for Litter.
@@ -1209,9 +1424,9 @@ class Litter(models.Model):
         on_delete=models.PROTECT)
 
     # The target genotype is slugged from the genotype of the mother
-    # and father
+    # and father. It is only populated when the litter is created; after
+    # that it is kept up to date by refresh_target_genotypes.
     target_genotype = AutoSlugField(populate_from=slug_target_genotype,
-        always_update=True,
         slugify=my_slugify,
     )
 
@@ -1230,6 +1445,15 @@ class Litter(models.Model):
     # track history with simple_history
     history = HistoricalRecords()
     
+    class Meta(object):
+        indexes = [
+            # For searching by target_genotype in CageAdmin, which uses
+            # UPPER(...) LIKE '%...%'. Equality lookups from list_filter
+            # use the index that AutoSlugField already creates.
+            GinIndex(OpClass(Upper('target_genotype'), name='gin_trgm_ops'),
+                name='colony_litter_target_trgm_idx'),
+        ]
+    
     def days_since_mating(self):
         if self.date_mated is None:
             return None
@@ -1282,10 +1506,14 @@ class Litter(models.Model):
     def info(self):
         """Returns a string like 10@P19"""
         bc_name = self.breeding_cage.name
-        try:
-            n_pups = len(self.mouse_set.all())
-        except AttributeError:
-            n_pups = 0
+        if hasattr(self, 'n_pups'):
+            # Annotated, for instance by LitterAdmin.get_queryset
+            n_pups = self.n_pups
+        else:
+            try:
+                n_pups = len(self.mouse_set.all())
+            except AttributeError:
+                n_pups = 0
         pup_age = self.age()
         pup_embryonic_age = self.days_since_mating()
         if pup_age is None:
@@ -1446,4 +1674,147 @@ class SpecialRequest(models.Model):
     date_completed = models.DateField('date completed', null=True, blank=True)
     
     # track history with simple_history
-    history = HistoricalRecords()
\ No newline at end of file
+    history = HistoricalRecords()
+
+
+class CageCensusRow(models.Model):
+    """Denormalized snapshot of how one Cage is displayed in the census.
+    
+    Rendering a cage in the census calls type_of_cage, relevant_genesets,
+    auto_needs_message, and Mouse.info() on every mouse, which is too slow
+    to do for every cage in the colony on every page view. Instead, the
+    rendered rows for each cage are stored here and read with one query.
+    
+    The signals in colony.signals mark a row stale whenever the cage or
+    anything displayed about it changes. A row computed on a previous day
+    is also out of date, because the ages and auto needs depend on today's
+    date. Out of date rows are recomputed by colony.census when needed.
+    
+    Fields:
+        cage : the Cage, also the primary key
+        stale : True if something displayed in this row has changed
+        version : incremented every time the row is marked stale, so that
+            a recompute does not clear a mark made while it was running
+        computed_on : the date this row was computed
+        type_of_cage : Cage.type_of_cage when computed
+        relevant_genesets : Cage.relevant_genesets when computed, as a
+            list of lists of gene names
+        rendered_html : the census table rows for this cage
+    """
+    cage = models.OneToOneField(Cage,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='census_row',
+    )
+    
+    # Set by signals whenever the cage or its mice change
+    stale = models.BooleanField(default=True, db_index=True)
+    version = models.PositiveIntegerField(default=0)
+    
+    # Ages and auto needs are only correct on the day they were computed
+    computed_on = models.DateField(null=True, blank=True)
+    
+    # The cached data
+    type_of_cage = models.CharField(max_length=30, blank=True)
+    relevant_genesets = models.JSONField(default=list, blank=True)
+    rendered_html = models.TextField(blank=True)
+    
+    def __str__(self):
+        return str(self.cage)
+    
+    def is_current(self, today=None):
+        """Returns True if this row can be displayed without recomputing"""
+        if today is None:
+            today = datetime.date.today()
+        return not self.stale and self.computed_on == today
+
+class DailyCageCount(models.Model):
+    """Number of cages and mice belonging to each proprietor on each day.
+    
+    Counting cages on a past date means replaying HistoricalCage and
+    HistoricalMouse, which grow with every save. Instead, each day is
+    counted once and stored here, so that reports over many days read only
+    this table.
+    
+    The counts are a snapshot at local midnight at the start of `date`,
+    the same dates that counts_by_person has always used. Only non-defunct
+    cages are counted, and only living mice in those cages. Rows where
+    both counts are zero are not stored.
+    
+    This table is filled and extended by the refresh_daily_cage_counts
+    management command, which should be run nightly. See colony.occupancy.
+    
+    Fields:
+        date : the day
+        proprietor : the Person the cages belonged to on that day
+        location : Cage.location on that day
+        n_cages : number of non-defunct cages
+        n_mice : number of living mice in those cages
+    """
+    date = models.DateField(db_index=True)
+    proprietor = models.ForeignKey(Person, on_delete=models.PROTECT)
+    location = models.IntegerField()
+    n_cages = models.IntegerField(default=0)
+    n_mice = models.IntegerField(default=0)
+    
+    class Meta(object):
+        ordering = ['date', 'proprietor', 'location']
+        unique_together = ('date', 'proprietor', 'location')
+    
+    def __str__(self):
+        return '{} {} {}'.format(self.date, self.proprietor, self.location)
+
+class CageNameSequence(models.Model):
+    """The last cage number generated in each cage series.
+    
+    Used by generate_cage_name to allocate cage names without reading
+    every existing cage name, and without two requests allocating the
+    same name.
+    
+    Fields:
+        series_number : Person.series_number of the series
+        last_number : the last cage number generated in this series,
+            or series_number * 1000 if none yet
+    """
+    series_number = models.IntegerField(unique=True)
+    last_number = models.IntegerField()
+    
+    def __str__(self):
+        return '{} {}'.format(self.series_number, self.last_number)
+
+class CageSearchDocument(models.Model):
+    """Denormalized text that the cage admin searches.
+    
+    Searching cages by the names of their mice, genes, and strains would
+    otherwise join Cage to Mouse, MouseGene, Gene, MouseStrain, and Strain,
+    which multiplies the rows and needs a DISTINCT over the whole colony.
+    Instead, all of the searchable text about each cage is stored here in
+    one column, with a trigram index for case-insensitive substring
+    search.
+    
+    The documents are built and searched by colony.search, and the
+    signals in colony.signals rebuild a cage's document whenever any of
+    that text changes.
+    
+    Fields:
+        cage : the Cage, also the primary key
+        document : the cage's name, sticker, and DAR id, and the names of
+            its mice and of their genes and strains, one per line
+    """
+    cage = models.OneToOneField(Cage,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='search_document',
+    )
+    
+    document = models.TextField(blank=True)
+    
+    class Meta(object):
+        indexes = [
+            # icontains is UPPER(...) LIKE '%...%'
+            GinIndex(OpClass(Upper('document'), name='gin_trgm_ops'),
+                name='colony_cagesearch_trgm_idx'),
+        ]
+    
+    def __str__(self):
+        return str(self.cage)
@@ -0,0 +1,372 @@
+"""Functions for counting cages and mice over time from the historical records.
+
+The state of a cage at any moment is given by its most recent
+HistoricalCage record before that moment. Rather than querying the history
+table once for every date of interest, these functions read the history
+once, convert each record into the interval of time during which it was
+the current record, and count the intervals that cover each date.
+
+Replaying the history still gets slower as the history tables grow, so
+the counts for each day are also stored in DailyCageCount by
+refresh_daily_cage_counts, which is run nightly by the management command
+of the same name. Reports should read the counts with
+rollup_cage_counts, which only replays the days that are not stored yet.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+import numpy as np
+import pandas
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Min, Sum
+
+from .models import HistoricalCage, HistoricalMouse, DailyCageCount, Person
+
+
+def read_history(history_model, fields, since=None):
+    """Read the historical records needed to replay the history.
+
+    history_model : a historical model, such as HistoricalCage
+    fields : list of field names to read. The first must be 'id' and the
+        second must be 'history_date'.
+    since : datetime or None
+        If None, every record is read. Otherwise, only the records from
+        `since` onward are read, plus the most recent record of each object
+        before `since`, which gives its state at `since`. This takes two
+        queries instead of one, but the number of records read no longer
+        grows with the age of the colony.
+
+    Returns: list of tuples of `fields`, sorted by id and then history_date,
+        suitable for history_intervals
+    """
+    # history_id breaks ties between records saved at the same moment
+    fields = list(fields) + ['history_id']
+    qs = history_model.objects.all()
+
+    if since is None:
+        records = list(qs.order_by(
+            'id', 'history_date', 'history_id').values_list(*fields))
+    else:
+        # DISTINCT ON is Postgres-only
+        records = list(qs.filter(history_date__lt=since).order_by(
+            'id', '-history_date', '-history_id').distinct('id').values_list(
+            *fields))
+        records += list(qs.filter(history_date__gte=since).values_list(
+            *fields))
+        records.sort(key=lambda record: (record[0], record[1], record[-1]))
+
+    return [record[:-1] for record in records]
+
+def history_intervals(records, columns):
+    """Convert historical records into the intervals when each was current.
+
+    records : list of tuples, sorted by object id and then history_date.
+        The first element of each tuple must be the object id and the
+        second must be the history_date.
+    columns : column names for the tuples in `records`
+
+    Returns: DataFrame
+        One row per record, with the columns in `columns` plus:
+        'start': history_date of this record, in UTC nanoseconds
+        'stop': history_date of the next record of the same object, in
+            UTC nanoseconds, or the maximum int64 if this is the latest
+    """
+    df = pandas.DataFrame.from_records(records, columns=columns)
+    id_col, date_col = columns[0], columns[1]
+
+    # Convert to UTC nanoseconds so that intervals can be compared
+    # to the target dates with searchsorted
+    start = pandas.to_datetime(df[date_col], utc=True).values.astype(np.int64)
+
+    # Each record is current until the next record of the same object
+    # The records are sorted by object id, so the next record is
+    # the next row, unless that row is a different object
+    stop = np.full(len(df), np.iinfo(np.int64).max, dtype=np.int64)
+    if len(df) > 1:
+        same_object = df[id_col].values[1:] == df[id_col].values[:-1]
+        stop[:-1] = np.where(same_object, start[1:], stop[:-1])
+
+    df['start'] = start
+    df['stop'] = stop
+    return df
+
+def count_intervals_by_group(intervals, groups, target_dates):
+    """Count the intervals covering each target date, within each group.
+
+    An interval covers a date if start <= date < stop. This is the same as
+    taking the most recent record with history_date <= date.
+
+    intervals : DataFrame with 'start' and 'stop' columns (see
+        history_intervals)
+    groups : array-like or MultiIndex, the same length as intervals, of
+        group labels
+    target_dates : DatetimeIndex, must be timezone-aware
+
+    Returns: DataFrame
+        Index: each distinct group label, sorted
+        Columns: target_dates, in the order given
+        Values: number of intervals covering that date
+    """
+    # Sort the target dates so that each interval covers a contiguous
+    # range of them
+    target_ns = target_dates.asi8
+    order = np.argsort(target_ns)
+    sorted_ns = target_ns[order]
+
+    # Find the range of sorted dates covered by each interval
+    first_covered = np.searchsorted(
+        sorted_ns, intervals['start'].values, side='left')
+    first_not_covered = np.searchsorted(
+        sorted_ns, intervals['stop'].values, side='left')
+
+    # Add +1 at the start and -1 after the end of each interval, per group,
+    # and take the cumulative sum over dates
+    group_codes, group_labels = pandas.factorize(groups, sort=True)
+    delta = np.zeros((len(group_labels), len(sorted_ns) + 1), dtype=int)
+    np.add.at(delta, (group_codes, first_covered), 1)
+    np.add.at(delta, (group_codes, first_not_covered), -1)
+    counts = np.cumsum(delta, axis=1)[:, :-1]
+
+    # Put the dates back in the requested order
+    res = pandas.DataFrame(np.empty_like(counts),
+        index=group_labels, columns=target_dates)
+    res.iloc[:, order] = counts
+    return res
+
+def cage_intervals(since=None):
+    """Intervals during which each cage existed and was not defunct.
+
+    since : passed to read_history
+
+    Returns: DataFrame, see history_intervals
+        Columns: 'id', 'history_date', 'location', 'proprietor_id',
+        'start', 'stop'
+    """
+    columns = ['id', 'history_date', 'history_type', 'defunct', 'location',
+        'proprietor_id']
+    intervals = history_intervals(
+        read_history(HistoricalCage, columns, since), columns)
+
+    # Exclude defunct and deleted cages
+    intervals = intervals[
+        ~intervals['defunct'].astype(bool) &
+        (intervals['history_type'] != '-')
+    ]
+    return intervals.drop(['history_type', 'defunct'], axis=1)
+
+def mouse_intervals(since=None):
+    """Intervals during which each living mouse was in each cage.
+
+    The interval of each mouse is intersected with the intervals of the
+    cage it was in, so a mouse only counts while its cage was non-defunct.
+
+    since : passed to read_history
+
+    Returns: DataFrame
+        Columns: 'location', 'proprietor_id' of the cage at that time,
+        'start', 'stop'
+    """
+    columns = ['id', 'history_date', 'history_type', 'cage_id', 'sack_date']
+    intervals = history_intervals(
+        read_history(HistoricalMouse, columns, since), columns)
+
+    # Exclude sacked, deleted, and uncaged mice
+    intervals = intervals[
+        intervals['sack_date'].isnull() &
+        intervals['cage_id'].notnull() &
+        (intervals['history_type'] != '-')
+    ]
+
+    # Pair each mouse interval with each interval of its cage, and keep
+    # the overlapping part
+    merged = intervals[['cage_id', 'start', 'stop']].merge(
+        cage_intervals(since)[['id', 'location', 'proprietor_id',
+        'start', 'stop']],
+        left_on='cage_id', right_on='id', suffixes=('_mouse', '_cage'))
+    merged['start'] = np.maximum(
+        merged['start_mouse'].values, merged['start_cage'].values)
+    merged['stop'] = np.minimum(
+        merged['stop_mouse'].values, merged['stop_cage'].values)
+    merged = merged[merged['start'] < merged['stop']]
+
+    return merged[['location', 'proprietor_id', 'start', 'stop']]
+
+def daily_cage_counts(target_dates, locations=(0, 4)):
+    """Count each proprietor's non-defunct cages at each target date.
+
+    This replays the history directly. Deleted cages are excluded. Cages
+    that contained no mice are included.
+
+    target_dates : DatetimeIndex, must be timezone-aware
+    locations : only count cages in these locations
+
+    Returns: DataFrame
+        Index: proprietor names, only those with at least one cage on
+            at least one of the target dates
+        Columns: target_dates, in the order given
+        Values: number of cages
+    """
+    # Only the history since the earliest date is needed
+    intervals = cage_intervals(since=target_dates.min())
+    intervals = intervals[intervals['location'].isin(locations)]
+
+    # Count by proprietor name
+    names = intervals['proprietor_id'].map(
+        dict(Person.objects.values_list('id', 'name')))
+    intervals = intervals[names.notnull()]
+    counts = count_intervals_by_group(
+        intervals, names[names.notnull()].values, target_dates)
+
+    # Drop proprietors with no cages at any of these dates
+    return counts.loc[counts.sum(1) > 0]
+
+def daily_occupancy(target_dates):
+    """Count cages and mice by proprietor and location at each target date.
+
+    target_dates : DatetimeIndex, must be timezone-aware
+
+    Returns: DataFrame
+        One row for each date, proprietor, and location with at least
+        one cage or mouse.
+        Columns: 'date' (the target date), 'proprietor_id', 'location',
+        'n_cages', 'n_mice'
+    """
+    since = target_dates.min()
+    counts = {}
+    for name, intervals in [
+            ('n_cages', cage_intervals(since)),
+            ('n_mice', mouse_intervals(since)),
+            ]:
+        if len(intervals) == 0:
+            # An empty MultiIndex cannot be factorized
+            continue
+        groups = pandas.MultiIndex.from_arrays(
+            [intervals['proprietor_id'], intervals['location']],
+            names=['proprietor_id', 'location'])
+        counts[name] = count_intervals_by_group(
+            intervals, groups, target_dates).stack()
+
+    columns = ['date', 'proprietor_id', 'location', 'n_cages', 'n_mice']
+    if 'n_cages' not in counts:
+        # No cages means no mice either
+        return pandas.DataFrame([], columns=columns)
+
+    # Combine into a single long DataFrame
+    res = pandas.concat(counts, axis=1).reindex(
+        columns=['n_cages', 'n_mice']).fillna(0).astype(int)
+    res.index.names = ['proprietor_id', 'location', 'date']
+    res = res.loc[(res['n_cages'] > 0) | (res['n_mice'] > 0)]
+    return res.reset_index()[columns]
+
+def local_midnights(dates):
+    """DatetimeIndex of local midnight at the start of each date"""
+    return pandas.DatetimeIndex(
+        [pandas.Timestamp(date) for date in dates]).tz_localize(
+        settings.TIME_ZONE)
+
+def refresh_daily_cage_counts(until=None, rebuild=False):
+    """Count the days since the last refresh and store them in DailyCageCount.
+
+    The first time this is run, every day since the first historical
+    record is counted. After that, only the days after the latest date
+    already stored are counted, so a nightly refresh replays only the
+    history since the previous night.
+
+    until : date, the last day to count. Defaults to today, whose counts
+        are final because they are taken at midnight.
+    rebuild : if True, delete every stored count and start over
+
+    Returns: list of the dates that were counted
+    """
+    if until is None:
+        until = datetime.date.today()
+
+    with transaction.atomic():
+        if rebuild:
+            DailyCageCount.objects.all().delete()
+
+        # Start after the last stored day, or else at the first record
+        last_date = DailyCageCount.objects.aggregate(
+            Max('date'))['date__max']
+        if last_date is not None:
+            first_date = last_date + datetime.timedelta(days=1)
+        else:
+            first_record = HistoricalCage.objects.aggregate(
+                Min('history_date'))['history_date__min']
+            if first_record is None:
+                return []
+            first_date = first_record.astimezone(
+                local_midnights([until]).tz).date()
+
+        if first_date > until:
+            return []
+
+        dates = [first_date + datetime.timedelta(days=n_day)
+            for n_day in range((until - first_date).days + 1)]
+        occupancy = daily_occupancy(local_midnights(dates))
+
+        # The history keeps the ids of deleted people, which cannot be stored
+        occupancy = occupancy[occupancy['proprietor_id'].isin(
+            Person.objects.values_list('id', flat=True))]
+
+        DailyCageCount.objects.bulk_create([
+            DailyCageCount(
+                date=row.date.date(),
+                proprietor_id=row.proprietor_id,
+                location=row.location,
+                n_cages=row.n_cages,
+                n_mice=row.n_mice,
+            ) for row in occupancy.itertuples()
+        ])
+
+    return dates
+
+def rollup_cage_counts(target_dates, locations=(0, 4)):
+    """Count each proprietor's non-defunct cages at each target date.
+
+    This returns the same result as daily_cage_counts, but reads the
+    counts from DailyCageCount. Only the target dates after the last
+    refresh are counted by replaying the history.
+
+    target_dates : DatetimeIndex of local midnights, such as from
+        pandas.date_range with tz=settings.TIME_ZONE. DailyCageCount is
+        only counted at midnight.
+    locations : only count cages in these locations
+
+    Returns: DataFrame, see daily_cage_counts
+    """
+    last_date = DailyCageCount.objects.aggregate(Max('date'))['date__max']
+    dates = pandas.Index(target_dates.date)
+    if last_date is None:
+        is_stored = np.zeros(len(dates), dtype=bool)
+    else:
+        is_stored = dates <= last_date
+
+    # Read the stored days with a single query
+    stored = pandas.DataFrame.from_records(
+        DailyCageCount.objects.filter(
+            date__in=list(dates[is_stored]),
+            location__in=locations,
+        ).values('date', 'proprietor__name').annotate(
+            n_cages=Sum('n_cages')),
+        columns=['date', 'proprietor__name', 'n_cages'])
+    # An empty column has dtype object, which pivot_table cannot sum
+    stored['n_cages'] = stored['n_cages'].astype(int)
+    counts = stored.pivot_table(index='proprietor__name', columns='date',
+        values='n_cages', aggfunc='sum').reindex(
+        columns=dates[is_stored])
+    counts.columns = target_dates[is_stored]
+
+    # Replay the rest
+    if not is_stored.all():
+        counts = pandas.concat([counts,
+            daily_cage_counts(target_dates[~is_stored], locations)], axis=1)
+
+    # Missing rows mean no cages
+    counts = counts.reindex(columns=target_dates).fillna(0).astype(int)
+    counts.index.name = None
+    counts.columns.name = None
+    return counts.loc[counts.sum(1) > 0].sort_index()
@@ -0,0 +1,100 @@
+"""A paginator for admin changelists of tables that only grow.
+
+Django's Paginator runs an exact COUNT(*) on every page view, which reads
+the whole table (or every row matching the filters). For large tables,
+EstimatedCountPaginator uses Postgres's own estimate of the number of
+rows instead: pg_class.reltuples for an unfiltered queryset, or the
+planner's row estimate for a filtered one. Small results are still
+counted exactly, since that is cheap.
+
+Use it together with show_full_result_count = False on the ModelAdmin,
+which otherwise counts the whole table once more.
+"""
+from __future__ import unicode_literals
+
+import json
+
+from django.core.paginator import EmptyPage, Paginator
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator that estimates the count of large querysets.
+
+    When the count is an estimate, count_is_estimate is True and any page
+    number from 1 up is allowed, so that the rows past the estimate can
+    still be shown if it is too low. A page past the last row is simply
+    empty. The colony admin's pagination.html shows the count as
+    "about N", and links past the last estimated page while the pages
+    are full.
+
+    exact_count_threshold : results estimated to have fewer rows than
+        this are counted exactly
+    """
+    exact_count_threshold = 10000
+
+    def __init__(self, *args, **kwargs):
+        super(EstimatedCountPaginator, self).__init__(*args, **kwargs)
+        self.count_is_estimate = False
+
+    @cached_property
+    def count(self):
+        """The number of objects, estimated if there are many of them"""
+        if not isinstance(self.object_list, QuerySet):
+            return super(EstimatedCountPaginator, self).count
+
+        estimate = self.estimate_count()
+        if estimate is None or estimate < self.exact_count_threshold:
+            return self.object_list.count()
+
+        self.count_is_estimate = True
+        return estimate
+
+    def estimate_count(self):
+        """Ask Postgres how many rows the queryset probably has.
+
+        Returns: int, or None if there is no estimate
+            pg_class.reltuples of the table if the queryset is not
+            filtered, otherwise the number of rows the planner expects
+        """
+        qs = self.object_list
+        if not qs.query.where and not qs.query.distinct:
+            with connections[qs.db].cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples FROM pg_class WHERE oid = %s::regclass",
+                    [qs.model._meta.db_table])
+                row = cursor.fetchone()
+
+            # reltuples is -1 if the table has never been analyzed
+            if row is None or row[0] < 0:
+                return None
+            return int(row[0])
+
+        # Planning is cheap, and does not read the rows
+        plan = json.loads(qs.order_by().explain(format='json'))
+        return int(plan[0]['Plan']['Plan Rows'])
+
+    def validate_number(self, number):
+        """Also allow pages past the last page of an estimated count"""
+        try:
+            return super(EstimatedCountPaginator, self).validate_number(
+                number)
+        except EmptyPage:
+            # int() cannot fail, since it was validated as an integer
+            if self.count_is_estimate and int(number) > 1:
+                return int(number)
+            raise
+
+    def page(self, number):
+        """Return a page, without trimming it to an estimated count"""
+        # Evaluating the count sets count_is_estimate
+        self.count
+        if not self.count_is_estimate:
+            return super(EstimatedCountPaginator, self).page(number)
+
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(
+            self.object_list[bottom:bottom + self.per_page], number, self)
@@ -0,0 +1,72 @@
+"""A small in-process cache for the results of the autocomplete views.
+
+Every user types the same short prefixes into the mouse autocomplete
+fields, so the same few queries are run over and over. This caches the
+JSON results of each query in the memory of each worker process.
+
+Entries expire after 5 seconds by default, and the oldest entries are
+evicted when the cache is full. Any change to a Mouse bumps the
+generation of the cache (see colony.signals), which invalidates every
+entry at once. Code that changes mice with QuerySet.update or bulk_create
+does not send those signals, so it should call invalidate directly.
+
+Invalidation only applies to the cache of the worker process that made
+the change. The other workers keep serving their own cached results
+until those expire, which is why the expiry is short: a mouse that was
+just added, renamed, or sacked can be missing or out of date in the other
+workers' results for at most a few seconds, while someone typing still
+gets each prefix from the cache.
+"""
+from __future__ import unicode_literals
+
+import collections
+import threading
+import time
+
+
+class ResultCache(object):
+    """A thread-safe LRU cache whose entries also expire after a time.
+    
+    max_size : maximum number of entries
+    ttl : number of seconds after which an entry expires
+    """
+    def __init__(self, max_size=512, ttl=5):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Returns the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            
+            generation, expires, value = entry
+            if generation != self.generation or expires < time.monotonic():
+                del self._entries[key]
+                return None
+            
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        """Store value for key, evicting the least recently used if full"""
+        with self._lock:
+            self._entries[key] = (
+                self.generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def invalidate(self):
+        """Invalidate every entry, by bumping the generation"""
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+# The results of the mouse autocomplete views in this worker
+autocomplete_results = ResultCache()
@@ -0,0 +1,100 @@
+"""Functions for searching cages through CageSearchDocument.
+
+Each cage has a CageSearchDocument with all of its searchable text on
+separate lines. A search term matches a cage if it is a substring of any
+of those lines, the same as an icontains lookup on each of the fields,
+but without joining the mice, genes, and strains of every cage.
+
+The signal handlers in colony.signals call refresh_search_documents
+whenever any of this text changes. Code that writes with QuerySet.update
+or bulk_create does not send those signals, so it must call it directly.
+"""
+from __future__ import unicode_literals
+
+from django.db.models import Q
+from django.utils.text import smart_split, unescape_string_literal
+
+from .models import CageSearchDocument, Litter
+
+
+def prefetch_for_search(qs):
+    """Prefetch everything in the search document of each cage.
+
+    qs : a queryset of Cage
+
+    Returns: the same queryset with prefetch_related
+    """
+    return qs.prefetch_related(
+        'mouse_set__mousegene_set__gene_name',
+        'mouse_set__mousestrain_set__strain_key',
+    )
+
+def cage_search_document(cage):
+    """The text to search for a cage.
+
+    cage : a Cage, ideally from a queryset passed through prefetch_for_search
+
+    Returns: string
+        The cage's name, sticker, and DAR id, followed by the names of
+        its mice and the distinct names of their genes and strains, one
+        per line. Search terms are split on whitespace, so a term can only
+        match across lines if it was quoted.
+    """
+    mice = list(cage.mouse_set.all())
+    gene_names = set()
+    strain_names = set()
+    for mouse in mice:
+        for mg in mouse.mousegene_set.all():
+            gene_names.add(mg.gene_name.name)
+        for ms in mouse.mousestrain_set.all():
+            strain_names.add(ms.strain_key.name)
+
+    lines = ([cage.name, cage.sticker, cage.dar_id] +
+        sorted(mouse.name for mouse in mice) +
+        sorted(gene_names) + sorted(strain_names))
+    return '\n'.join(line for line in lines if line)
+
+def refresh_search_documents(cages):
+    """Rebuild and save the search documents of these cages.
+
+    cages : queryset of Cage
+
+    Returns: number of documents saved
+    """
+    documents = [
+        CageSearchDocument(cage=cage, document=cage_search_document(cage))
+        for cage in prefetch_for_search(cages)
+    ]
+
+    # Insert new documents and overwrite existing ones
+    CageSearchDocument.objects.bulk_create(documents,
+        update_conflicts=True,
+        unique_fields=['cage'],
+        update_fields=['document'],
+    )
+    return len(documents)
+
+def search_cages(qs, search_term):
+    """Filter cages the same way as the admin search on CageAdmin.
+
+    The search term is split into words the same way as the admin does.
+    Each word must match either the cage's search document or its
+    litter's target_genotype, which has its own index. Both are looked up
+    with subqueries, so the result has no duplicates.
+
+    qs : a queryset of Cage
+    search_term : the text typed into the search box
+
+    Returns: filtered queryset
+    """
+    for term in smart_split(search_term):
+        if term.startswith(('"', "'")) and term[0] == term[-1]:
+            term = unescape_string_literal(term)
+        # Each condition is a subquery on a single table, so that each
+        # can use its own trigram index
+        qs = qs.filter(
+            Q(pk__in=CageSearchDocument.objects.filter(
+                document__icontains=term).values('cage')) |
+            Q(pk__in=Litter.objects.filter(
+                target_genotype__icontains=term).values('breeding_cage')))
+    return qs
@@ -0,0 +1,148 @@
+"""Operations that change several objects at once.
+
+Each operation runs in a single transaction, so it either completes or
+changes nothing. Objects are written with bulk queries or QuerySet.update,
+together with their history, so these can be called from views and admin
+actions alike. Bulk queries do not send signals, so each operation also updates
+colony.census, colony.result_cache, colony.search, and
+Litter.target_genotype directly.
+"""
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import transaction
+from simple_history.utils import (
+    bulk_create_with_history, bulk_update_with_history)
+
+from .models import Cage, Litter, Mouse, refresh_target_genotypes
+from .census import mark_cages_stale, mark_mice_stale
+from .result_cache import autocomplete_results
+from .search import refresh_search_documents
+
+
+# The suffix of the weaning cage for each sex of pup
+WEANING_CAGE_SUFFIXES = [
+    (0, '-M'),
+    (1, '-F'),
+    (2, '-PUP'),
+]
+
+def group_pups_by_sex(pups):
+    """Group mice by sex.
+
+    Returns: dict
+        Keys are the sexes in WEANING_CAGE_SUFFIXES and values are lists
+        of mice with that sex, in the same order as `pups`
+    """
+    res = dict((sex, []) for sex, suffix in WEANING_CAGE_SUFFIXES)
+    for pup in pups:
+        res[pup.sex].append(pup)
+    return res
+
+def wean_litter(cage, today=None):
+    """Wean the pups of the litter in this breeding cage into new cages.
+
+    A new weaning cage is created for each sex of pup that is present,
+    named after the breeding cage with a suffix from WEANING_CAGE_SUFFIXES.
+    The pups are moved into them and the litter's date_weaned is set.
+    This all happens in one transaction, so if any step fails (for
+    instance, a cage with one of the new names already exists) no pup is
+    moved.
+
+    cage : Cage with a litter
+    today : date to stamp as date_weaned, defaults to today
+
+    Returns: dict
+        Keys are the sexes of the pups and values are the new Cage they
+        were moved into
+    """
+    if today is None:
+        today = datetime.date.today()
+    litter = cage.litter
+
+    with transaction.atomic():
+        # Fetch the pups once
+        pups_by_sex = group_pups_by_sex(litter.mouse_set.all())
+
+        # Create a cage for each sex that has pups
+        sexes = [sex for sex, suffix in WEANING_CAGE_SUFFIXES
+            if len(pups_by_sex[sex]) > 0]
+        new_cages = bulk_create_with_history([
+            Cage(
+                name=cage.name + suffix,
+                location=cage.location,
+                proprietor=cage.proprietor,
+                notes='',
+                dar_type=2, # weaning type
+            ) for sex, suffix in WEANING_CAGE_SUFFIXES if sex in sexes
+        ], Cage)
+        new_cage_by_sex = dict(zip(sexes, new_cages))
+
+        # Move all the pups at once
+        moved_pups = []
+        for sex, new_cage in new_cage_by_sex.items():
+            for pup in pups_by_sex[sex]:
+                pup.cage = new_cage
+                moved_pups.append(pup)
+        if len(moved_pups) > 0:
+            bulk_update_with_history(moved_pups, Mouse, ['cage'])
+
+        litter.date_weaned = today
+        litter.save()
+
+    # Bulk updates do not send signals
+    mark_mice_stale([pup.pk for pup in moved_pups], cage_ids=[cage.pk])
+    autocomplete_results.invalidate()
+    refresh_search_documents(Cage.objects.filter(pk__in=[cage.pk] +
+        [new_cage.pk for new_cage in new_cage_by_sex.values()]))
+
+    return new_cage_by_sex
+
+def sack_cages(cage_ids, sack_date=None):
+    """Make these cages defunct and sack every mouse in them.
+
+    Cages that are already defunct and mice that are already sacked are
+    left as they are, so sacking a cage twice does not change the
+    recorded sack dates. The cages and the mice are each changed with one
+    UPDATE query, and their history is written in bulk, all in one
+    transaction.
+
+    cage_ids : ids of the Cage to sack
+    sack_date : date to stamp as sack_date, defaults to today
+
+    Returns: tuple (n_cages, n_mice)
+        The number of cages made defunct and of mice sacked
+    """
+    if sack_date is None:
+        sack_date = datetime.date.today()
+    cage_ids = list(cage_ids)
+
+    with transaction.atomic():
+        # Lock the rows that will change, and keep them for the history
+        cages = list(Cage.objects.select_for_update().filter(
+            pk__in=cage_ids, defunct=False))
+        mice = list(Mouse.objects.select_for_update().filter(
+            cage__in=cage_ids, sack_date__isnull=True))
+
+        Cage.objects.filter(pk__in=[cage.pk for cage in cages]).update(
+            defunct=True)
+        Mouse.objects.filter(pk__in=[mouse.pk for mouse in mice]).update(
+            sack_date=sack_date)
+
+        # Record the new versions in the history
+        for cage in cages:
+            cage.defunct = True
+        for mouse in mice:
+            mouse.sack_date = sack_date
+        Cage.history.bulk_history_create(cages, update=True)
+        Mouse.history.bulk_history_create(mice, update=True)
+
+    # Updates do not send signals
+    refresh_target_genotypes(Litter.objects.filter(
+        breeding_cage__in=[cage.pk for cage in cages]))
+    mark_cages_stale([cage.pk for cage in cages])
+    mark_mice_stale([mouse.pk for mouse in mice])
+    autocomplete_results.invalidate()
+
+    return len(cages), len(mice)
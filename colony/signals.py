@@ -0,0 +1,223 @@
+"""Signal handlers that keep denormalized data and caches up to date.
+
+These are connected when the app is ready, see ColonyConfig.ready.
+
+Anything that changes what the census displays about a cage marks that
+cage's CageCensusRow stale. Any change to a mouse also invalidates the
+cached autocomplete results. Any change to what Litter.target_genotype,
+Mouse.genotype_cache, or Mouse.strain_cache depends on refreshes them,
+and any change to the text that the cage admin searches refreshes that
+cage's CageSearchDocument.
+Note that QuerySet.update and bulk_create do not send these signals, so
+that code must call colony.census, colony.result_cache,
+refresh_target_genotypes, refresh_mouse_caches, and colony.search
+directly.
+"""
+from __future__ import unicode_literals
+
+from django.db.models import Q
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import (Cage, Mouse, Litter, MouseGene, MouseStrain,
+    SpecialRequest, Person, Gene, Strain, CageCensusRow,
+    compute_target_genotype, refresh_target_genotypes,
+    format_genotype, format_strain_description, refresh_mouse_caches)
+from .census import mark_cages_stale, mark_mice_stale, mark_rows_stale
+from .result_cache import autocomplete_results
+from .search import refresh_search_documents
+
+
+@receiver(post_save, sender=Cage)
+def cage_changed(sender, instance, **kwargs):
+    # Deleting the cage also deletes its row, so only post_save is needed
+    mark_cages_stale([instance.pk])
+
+@receiver(pre_save, sender=Mouse)
+def remember_previous_cage(sender, instance, update_fields=None, **kwargs):
+    """Store the cage this mouse was in before the save.
+
+    That cage needs to be marked stale too if the mouse is moving. The
+    previous pure_wild_type is stored too, for update_genotype_cache.
+
+    These are usually the values that Mouse.from_db remembered, so no
+    query is needed. They are only read from the database if the mouse
+    was not loaded from it, or was loaded without these fields.
+    """
+    saved_values = getattr(instance, '_saved_values', {})
+    if instance.pk is None:
+        previous = None
+    elif all(name in saved_values for name in Mouse.TRACKED_FIELDS):
+        previous = (saved_values['cage_id'], saved_values['pure_wild_type'])
+    elif (update_fields is not None and
+            not set(update_fields) & {'cage', 'cage_id', 'pure_wild_type'}):
+        # Neither is saved, so neither changes
+        previous = (instance.cage_id, instance.pure_wild_type)
+    else:
+        previous = Mouse.objects.filter(pk=instance.pk).values_list(
+            'cage_id', 'pure_wild_type').first()
+
+    if previous is None:
+        instance._previous_cage_id = None
+        instance._previous_pure_wild_type = None
+    else:
+        instance._previous_cage_id, instance._previous_pure_wild_type = (
+            previous)
+
+@receiver(post_save, sender=Mouse)
+def remember_saved_values(sender, instance, update_fields=None, **kwargs):
+    """Update the values that remember_previous_cage reads, after a save"""
+    saved_values = getattr(instance, '_saved_values', {})
+    for name in Mouse.TRACKED_FIELDS:
+        field_name = 'cage' if name == 'cage_id' else name
+        if (update_fields is None or name in update_fields or
+                field_name in update_fields):
+            saved_values[name] = getattr(instance, name)
+    instance._saved_values = saved_values
+
+@receiver(pre_save, sender=Mouse)
+def update_genotype_cache(sender, instance, **kwargs):
+    """Fill in the stored genotype and strain before the save.
+
+    A new mouse has no MouseGene or MouseStrain yet. For an existing
+    mouse, only a change to pure_wild_type can change the genotype here.
+    """
+    if instance._state.adding:
+        instance.genotype_cache = format_genotype(instance.pure_wild_type, [])
+        instance.strain_cache = format_strain_description([])
+    elif instance._previous_pure_wild_type != instance.pure_wild_type:
+        instance.genotype_cache = instance.genotype
+
+@receiver([post_save, post_delete], sender=Mouse)
+def mouse_changed(sender, instance, **kwargs):
+    # litter_id is the pk of the litter's breeding cage
+    # These are passed explicitly in case the mouse was just deleted
+    mark_mice_stale([instance.pk], cage_ids=[
+        instance.cage_id,
+        instance.litter_id,
+        getattr(instance, '_previous_cage_id', None),
+    ])
+
+@receiver([post_save, post_delete], sender=Mouse)
+def invalidate_autocomplete_results(sender, instance, **kwargs):
+    # The name, sex, or sack date may have changed
+    autocomplete_results.invalidate()
+
+@receiver([post_save, post_delete], sender=Litter)
+def litter_changed(sender, instance, **kwargs):
+    mark_cages_stale([instance.breeding_cage_id])
+
+@receiver([post_save, post_delete], sender=MouseGene)
+def mouse_gene_changed(sender, instance, **kwargs):
+    mark_mice_stale([instance.mouse_name_id])
+
+@receiver([post_save, post_delete], sender=MouseStrain)
+def mouse_strain_changed(sender, instance, **kwargs):
+    mark_mice_stale([instance.mouse_key_id])
+
+@receiver([post_save, post_delete], sender=SpecialRequest)
+def special_request_changed(sender, instance, **kwargs):
+    mark_cages_stale([instance.cage_id])
+
+@receiver(post_save, sender=Person)
+def person_changed(sender, instance, **kwargs):
+    # The person's name is displayed as proprietor and as mouse user
+    mark_rows_stale(CageCensusRow.objects.filter(
+        Q(cage__proprietor=instance) | Q(cage__mouse__user=instance)
+    ))
+
+@receiver(post_save, sender=Gene)
+@receiver(post_save, sender=Strain)
+def gene_or_strain_changed(sender, instance, **kwargs):
+    # These are rarely renamed, so just recompute everything
+    mark_rows_stale(CageCensusRow.objects.all())
+
+@receiver(pre_save, sender=Litter)
+def update_target_genotype_of_new_parents(sender, instance, **kwargs):
+    """Recompute target_genotype if the parents of the litter changed.
+
+    New litters are populated by AutoSlugField itself.
+    """
+    if instance._state.adding:
+        return
+    previous_parents = Litter.objects.filter(pk=instance.pk).values_list(
+        'father_id', 'mother_id').first()
+    if previous_parents != (instance.father_id, instance.mother_id):
+        instance.target_genotype = compute_target_genotype(instance)
+
+@receiver([post_save, post_delete], sender=MouseGene)
+def mouse_gene_changed_target_genotype(sender, instance, **kwargs):
+    # The genotype of a parent may have changed
+    refresh_target_genotypes(Litter.objects.filter(
+        Q(father=instance.mouse_name_id) | Q(mother=instance.mouse_name_id)))
+
+@receiver(post_save, sender=Mouse)
+def mouse_changed_target_genotype(sender, instance, **kwargs):
+    # A parent may have become pure wild type, which changes its genotype
+    refresh_target_genotypes(Litter.objects.filter(
+        Q(father=instance.pk) | Q(mother=instance.pk)))
+
+@receiver(post_save, sender=Cage)
+def cage_changed_target_genotype(sender, instance, **kwargs):
+    # The litters of defunct breeding cages have target genotype 'NA'
+    refresh_target_genotypes(Litter.objects.filter(breeding_cage=instance))
+
+@receiver(post_save, sender=Gene)
+def gene_changed_target_genotype(sender, instance, **kwargs):
+    # Genes are rarely renamed, so just recompute every litter
+    refresh_target_genotypes(Litter.objects.all())
+
+@receiver([post_save, post_delete], sender=MouseGene)
+def mouse_gene_changed_mouse_caches(sender, instance, **kwargs):
+    refresh_mouse_caches(Mouse.objects.filter(pk=instance.mouse_name_id))
+
+@receiver([post_save, post_delete], sender=MouseStrain)
+def mouse_strain_changed_mouse_caches(sender, instance, **kwargs):
+    refresh_mouse_caches(Mouse.objects.filter(pk=instance.mouse_key_id))
+
+@receiver(post_save, sender=Gene)
+def gene_changed_mouse_caches(sender, instance, **kwargs):
+    # The gene may have been renamed
+    refresh_mouse_caches(Mouse.objects.filter(
+        pk__in=MouseGene.objects.filter(gene_name=instance).values(
+        'mouse_name')))
+
+@receiver(post_save, sender=Strain)
+def strain_changed_mouse_caches(sender, instance, **kwargs):
+    # The strain may have been renamed
+    refresh_mouse_caches(Mouse.objects.filter(
+        pk__in=MouseStrain.objects.filter(strain_key=instance).values(
+        'mouse_key')))
+
+@receiver(post_save, sender=Cage)
+def cage_changed_search_document(sender, instance, **kwargs):
+    # The name, sticker, or DAR id may have changed
+    refresh_search_documents(Cage.objects.filter(pk=instance.pk))
+
+@receiver([post_save, post_delete], sender=Mouse)
+def mouse_changed_search_document(sender, instance, **kwargs):
+    # The mouse may have been renamed, or moved out of its previous cage
+    refresh_search_documents(Cage.objects.filter(pk__in=[
+        instance.cage_id, getattr(instance, '_previous_cage_id', None)]))
+
+@receiver([post_save, post_delete], sender=MouseGene)
+def mouse_gene_changed_search_document(sender, instance, **kwargs):
+    refresh_search_documents(Cage.objects.filter(
+        mouse=instance.mouse_name_id))
+
+@receiver([post_save, post_delete], sender=MouseStrain)
+def mouse_strain_changed_search_document(sender, instance, **kwargs):
+    refresh_search_documents(Cage.objects.filter(
+        mouse=instance.mouse_key_id))
+
+@receiver(post_save, sender=Gene)
+def gene_changed_search_document(sender, instance, **kwargs):
+    # The gene may have been renamed
+    refresh_search_documents(Cage.objects.filter(pk__in=Mouse.objects.filter(
+        mousegene__gene_name=instance).values('cage')))
+
+@receiver(post_save, sender=Strain)
+def strain_changed_search_document(sender, instance, **kwargs):
+    # The strain may have been renamed
+    refresh_search_documents(Cage.objects.filter(pk__in=Mouse.objects.filter(
+        mousestrain__strain_key=instance).values('cage')))
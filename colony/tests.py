@@ -1,3 +1,998 @@
-from django.test import TestCase
+import datetime
+import io
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.paginator import EmptyPage
+from django.db import IntegrityError, connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from simple_history.manager import HistoryManager
+
+from .admin import CageAdmin
+from .models import (Person, Cage, Mouse, Litter, SpecialRequest,
+    CageCensusRow, CageSearchDocument, DailyCageCount, Gene, MouseGene,
+    Strain, MouseStrain, HistoricalCage, HistoricalMouse, generate_cage_name)
+from .pagination import EstimatedCountPaginator
+from .views import summary_table_data, add_pups_to_litter
+import colony.views
+import colony.census
+import colony.history
+import colony.occupancy
+import colony.search
+import colony.services
+import colony.result_cache
+
+
+def legacy_summary_table_data():
+    """The summary counts as originally computed, one query per person"""
+    persons = Person.objects.all()
+    mice = Mouse.objects.all()
+    cages = Cage.objects.all()
+
+    all_table_data = [{
+        'name': person.name,
+        'cages': cages.filter(proprietor=person).count(),
+        'mice': mice.filter(cage__proprietor=person).count(),
+    } for person in persons]
+
+    all_table_data.append({
+        'name': 'No Cage',
+        'cages': 0,
+        'mice': mice.filter(cage__isnull=True).count()
+    })
+
+    current_table_data = [{
+        'name': person.name,
+        'cages': cages.filter(
+            proprietor=person, defunct=False, location__in=[0, 4]).exclude(
+            mouse__isnull=True).count(),
+        'mice': mice.filter(cage__proprietor=person,
+            cage__defunct=False, cage__location__in=[0, 4]).count(),
+    } for person in persons]
+
+    return all_table_data, current_table_data
+
+class SummaryTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+        bob = Person.objects.create(
+            name='bob', login_name='bob', series_number=2)
+
+        # A person with no cages at all
+        Person.objects.create(
+            name='carol', login_name='carol', series_number=3)
+
+        # Cages of each kind: current, empty, defunct, and elsewhere
+        cages = [
+            Cage.objects.create(name='1001', proprietor=alice),
+            Cage.objects.create(name='1002', proprietor=alice),
+            Cage.objects.create(name='1003', proprietor=alice, defunct=True),
+            Cage.objects.create(name='1004', proprietor=alice, location=1),
+            Cage.objects.create(name='2001', proprietor=bob),
+            Cage.objects.create(name='2002', proprietor=bob, location=4),
+            Cage.objects.create(name='2003', proprietor=bob, defunct=True),
+        ]
+
+        # Several mice per cage, and some without a cage
+        n_mice_per_cage = [3, 0, 2, 1, 1, 4, 0]
+        for cage, n_mice in zip(cages, n_mice_per_cage):
+            for n_mouse in range(n_mice):
+                Mouse.objects.create(
+                    name='{}-{}'.format(cage.name, n_mouse + 1),
+                    sex=n_mouse % 3, cage=cage)
+        Mouse.objects.create(name='uncaged-1', sex=2)
+        Mouse.objects.create(name='uncaged-2', sex=2)
+
+    def test_matches_legacy_counts(self):
+        self.assertEqual(summary_table_data(), legacy_summary_table_data())
+
+    def test_num_queries(self):
+        # Persons, cages, and mice, no matter how many people
+        with self.assertNumQueries(3):
+            summary_table_data()
+
+def create_colony_history(first_day):
+    """Save cages and mice with history over the six days from first_day.
+
+    Each change is recorded at local noon on its day, a minute apart.
+    There are moves between cages and locations, a sacked mouse, a cage
+    made defunct with mice still in it, and a deleted cage.
+    """
+    alice = Person.objects.create(
+        name='alice', login_name='alice', series_number=1)
+    bob = Person.objects.create(
+        name='bob', login_name='bob', series_number=2)
+
+    times = iter(range(1000))
+    def at(n_day, obj):
+        obj._history_date = (
+            colony.occupancy.local_midnights([first_day])[0] +
+            datetime.timedelta(days=n_day, hours=12, minutes=next(times))
+            ).to_pydatetime()
+        return obj
+
+    def save(n_day, obj):
+        at(n_day, obj).save()
+        return obj
+
+    # Day 0
+    cage1 = save(0, Cage(name='1001', proprietor=alice, location=0))
+    mouse1 = save(0, Mouse(name='1001-1', sex=0, cage=cage1))
+    mouse2 = save(0, Mouse(name='1001-2', sex=1, cage=cage1))
+
+    # Day 1
+    cage2 = save(1, Cage(name='2001', proprietor=bob, location=4))
+    save(1, Mouse(name='2001-1', sex=0, cage=cage2))
+    cage3 = save(1, Cage(name='1003', proprietor=alice, location=0))
+
+    # Day 2: a move between cages of different people
+    mouse2.cage = cage2
+    save(2, mouse2)
+
+    # Day 3: a sacked mouse, and a cage in another location
+    mouse1.sack_date = first_day + datetime.timedelta(days=3)
+    save(3, mouse1)
+    cage4 = save(3, Cage(name='1002', proprietor=alice, location=1))
+    save(3, Mouse(name='1002-1', sex=2, cage=cage4))
+
+    # Day 4: a defunct cage with mice still in it, and a cage moved
+    cage2.defunct = True
+    save(4, cage2)
+    cage1.location = 4
+    save(4, cage1)
+
+    # Day 5: a deleted cage, and a cage given to someone else
+    at(5, cage3).delete()
+    cage4.proprietor = bob
+    save(5, cage4)
+
+def legacy_cage_counts(target_dates, locations=(0, 4)):
+    """The cage counts as originally computed by counts_by_person.
+
+    Returns: dict
+        Keys are (proprietor name, target date) and values are the
+        number of cages, if not zero
+    """
+    res = {}
+    for target_date in target_dates:
+        qs1 = HistoricalCage.objects.filter(
+            history_date__lte=target_date).order_by(
+            'id', '-history_date').distinct('id')
+        qs2 = HistoricalCage.objects.filter(
+            history_id__in=qs1.values_list('history_id', flat=True),
+            defunct=False, location__in=locations).exclude(history_type='-')
+        for name in qs2.values_list('proprietor__name', flat=True):
+            res[name, target_date] = res.get((name, target_date), 0) + 1
+    return res
+
+def legacy_occupancy(target_dates):
+    """Count cages and mice on each date in the same way, one date at a time.
+
+    Returns: dict
+        Keys are (target date, proprietor_id, location) and values are
+        (n_cages, n_mice), if not both zero
+    """
+    res = {}
+    for target_date in target_dates:
+        latest_records = {}
+        for history_model in [HistoricalCage, HistoricalMouse]:
+            qs1 = history_model.objects.filter(
+                history_date__lte=target_date).order_by(
+                'id', '-history_date').distinct('id')
+            latest_records[history_model] = history_model.objects.filter(
+                history_id__in=qs1.values_list('history_id', flat=True)
+                ).exclude(history_type='-')
+
+        cages = {cage.id: cage
+            for cage in latest_records[HistoricalCage].filter(defunct=False)}
+        for cage in cages.values():
+            key = (target_date, cage.proprietor_id, cage.location)
+            n_cages, n_mice = res.get(key, (0, 0))
+            res[key] = (n_cages + 1, n_mice)
+
+        for mouse in latest_records[HistoricalMouse].filter(
+                sack_date__isnull=True, cage_id__in=list(cages)):
+            cage = cages[mouse.cage_id]
+            key = (target_date, cage.proprietor_id, cage.location)
+            n_cages, n_mice = res[key]
+            res[key] = (n_cages, n_mice + 1)
+    return res
+
+class OccupancyTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.first_day = datetime.date.today() - datetime.timedelta(days=10)
+        create_colony_history(cls.first_day)
+
+    def target_dates(self, first_n_day, n_days):
+        return colony.occupancy.local_midnights([
+            self.first_day + datetime.timedelta(days=n_day)
+            for n_day in range(first_n_day, first_n_day + n_days)])
+
+    def test_cage_counts_match_legacy(self):
+        # From before the first record, and from partway through, which
+        # reads only the latest record before the first date
+        for target_dates in [self.target_dates(0, 8),
+                self.target_dates(3, 5), self.target_dates(4, 1)]:
+            counts = colony.occupancy.daily_cage_counts(target_dates)
+            self.assertEqual(
+                {key: n for key, n in counts.stack().items() if n > 0},
+                legacy_cage_counts(target_dates))
+
+    def test_cage_counts_in_any_order(self):
+        target_dates = self.target_dates(0, 8)[::-1]
+        counts = colony.occupancy.daily_cage_counts(target_dates)
+        self.assertEqual(list(counts.columns), list(target_dates))
+        self.assertEqual(
+            {key: n for key, n in counts.stack().items() if n > 0},
+            legacy_cage_counts(target_dates))
+
+    def test_occupancy_matches_legacy(self):
+        for target_dates in [self.target_dates(0, 8),
+                self.target_dates(3, 5)]:
+            occupancy = colony.occupancy.daily_occupancy(target_dates)
+            self.assertEqual({
+                (row.date, row.proprietor_id, row.location):
+                (row.n_cages, row.n_mice)
+                for row in occupancy.itertuples()
+            }, legacy_occupancy(target_dates))
+
+class DailyCageCountTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.first_day = datetime.date.today() - datetime.timedelta(days=10)
+        create_colony_history(cls.first_day)
+
+    def day(self, n_day):
+        return self.first_day + datetime.timedelta(days=n_day)
+
+    def target_dates(self):
+        # From before the first record through today
+        return colony.occupancy.local_midnights(
+            [self.day(n_day) for n_day in range(-1, 11)])
+
+    def nonzero_counts(self, counts):
+        return {key: n for key, n in counts.stack().items() if n > 0}
+
+    def stored_counts(self):
+        return {(row.date, row.proprietor_id, row.location):
+            (row.n_cages, row.n_mice)
+            for row in DailyCageCount.objects.all()}
+
+    def test_rollup_matches_replay(self):
+        target_dates = self.target_dates()
+        replayed = self.nonzero_counts(
+            colony.occupancy.daily_cage_counts(target_dates))
+
+        # Nothing stored yet, then stored up to each day in turn, so that
+        # the replayed tail starts on each side of every change
+        self.assertEqual(self.nonzero_counts(
+            colony.occupancy.rollup_cage_counts(target_dates)), replayed)
+        for n_day in range(0, 11):
+            colony.occupancy.refresh_daily_cage_counts(
+                until=self.day(n_day), rebuild=True)
+            self.assertEqual(self.nonzero_counts(
+                colony.occupancy.rollup_cage_counts(target_dates)), replayed)
+
+    def test_stores_same_counts_as_replay(self):
+        dates = colony.occupancy.refresh_daily_cage_counts(
+            until=self.day(8))
+        self.assertEqual(dates, [self.day(n_day) for n_day in range(0, 9)])
+        self.assertEqual(self.stored_counts(), {
+            (date.date(), proprietor_id, location): counts
+            for (date, proprietor_id, location), counts in
+            legacy_occupancy(colony.occupancy.local_midnights(dates)).items()
+        })
+
+    def test_refresh_continues_from_last_day(self):
+        colony.occupancy.refresh_daily_cage_counts(until=self.day(8))
+        expected = self.stored_counts()
+
+        DailyCageCount.objects.filter(date__gt=self.day(3)).delete()
+        dates = colony.occupancy.refresh_daily_cage_counts(
+            until=self.day(8))
+        self.assertEqual(dates, [self.day(n_day) for n_day in range(4, 9)])
+        self.assertEqual(self.stored_counts(), expected)
+
+        # Already up to date
+        self.assertEqual(colony.occupancy.refresh_daily_cage_counts(
+            until=self.day(8)), [])
+
+    def test_rebuild_starts_over(self):
+        colony.occupancy.refresh_daily_cage_counts(until=self.day(8))
+        expected = self.stored_counts()
+
+        # A stored count that no longer matches the history
+        DailyCageCount.objects.filter(date=self.day(2)).update(n_cages=99)
+        dates = colony.occupancy.refresh_daily_cage_counts(
+            until=self.day(8), rebuild=True)
+        self.assertEqual(dates, [self.day(n_day) for n_day in range(0, 9)])
+        self.assertEqual(self.stored_counts(), expected)
+
+        target_dates = self.target_dates()
+        self.assertEqual(
+            self.nonzero_counts(
+            colony.occupancy.rollup_cage_counts(target_dates)),
+            self.nonzero_counts(
+            colony.occupancy.daily_cage_counts(target_dates)))
+
+    def test_command(self):
+        stdout = io.StringIO()
+        call_command('refresh_daily_cage_counts',
+            until=self.day(3).isoformat(), stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Counted 4 days from {} to {}\n'
+            .format(self.day(0), self.day(3)))
+
+        stdout = io.StringIO()
+        call_command('refresh_daily_cage_counts',
+            until=self.day(3).isoformat(), stdout=stdout)
+        self.assertEqual(stdout.getvalue(), 'Already up to date\n')
+
+        with self.assertRaises(CommandError):
+            call_command('refresh_daily_cage_counts', until='yesterday')
+
+class GenerateCageNameTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = Person.objects.create(
+            name='alice', login_name='alice', series_number=3)
+        Cage.objects.create(name='3005', proprietor=alice)
+        Cage.objects.create(name='3007', proprietor=alice)
+        Cage.objects.create(name='4001', proprietor=alice)
+    
+    def test_continues_from_highest_cage(self):
+        self.assertEqual(generate_cage_name(3), '3008')
+        self.assertEqual(generate_cage_name(3), '3009')
+    
+    def test_skips_names_taken_by_hand(self):
+        self.assertEqual(generate_cage_name(3), '3008')
+        Cage.objects.create(name='3009',
+            proprietor=Person.objects.get(name='alice'))
+        self.assertEqual(generate_cage_name(3), '3010')
+    
+    def test_does_not_read_every_cage_once_started(self):
+        generate_cage_name(3)
+        
+        # Lock the sequence, check the name is free, and save the sequence
+        # (plus the savepoint of the atomic block inside the test)
+        with CaptureQueriesContext(connection) as context:
+            with self.assertNumQueries(5):
+                self.assertEqual(generate_cage_name(3), '3009')
+        for query in context.captured_queries:
+            self.assertNotIn('SELECT "colony_cage"."name"', query['sql'])
+
+class CensusRowTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+        cls.cage = Cage.objects.create(name='1001', proprietor=alice)
+        Mouse.objects.create(name='1001-1', sex=0, cage=cls.cage)
+    
+    def test_refresh_clears_stale(self):
+        colony.census.refresh_census_rows([self.cage.pk])
+        self.assertFalse(CageCensusRow.objects.get(cage=self.cage).stale)
+        
+        colony.census.mark_cages_stale([self.cage.pk])
+        colony.census.refresh_census_rows([self.cage.pk])
+        self.assertFalse(CageCensusRow.objects.get(cage=self.cage).stale)
+    
+    def test_keeps_mark_made_during_refresh(self):
+        colony.census.refresh_census_rows([self.cage.pk])
+        colony.census.mark_cages_stale([self.cage.pk])
+        
+        # Another request changes the cage while the row is recomputed
+        compute_census_row = colony.census.compute_census_row
+        def compute_and_mark(cage, today=None):
+            row = compute_census_row(cage, today)
+            colony.census.mark_cages_stale([cage.pk])
+            return row
+        
+        with mock.patch('colony.census.compute_census_row', compute_and_mark):
+            colony.census.refresh_census_rows([self.cage.pk])
+        self.assertTrue(CageCensusRow.objects.get(cage=self.cage).stale)
+
+class MouseSaveTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+        cls.cages = [Cage.objects.create(name=name, proprietor=alice)
+            for name in ['1001', '1002', '1003']]
+        Mouse.objects.create(name='1001-1', sex=0, cage=cls.cages[0])
+        colony.census.refresh_census_rows([cage.pk for cage in cls.cages])
+    
+    def stale_cage_names(self):
+        return sorted(CageCensusRow.objects.filter(stale=True).values_list(
+            'cage__name', flat=True))
+    
+    def test_moves_without_reading_previous_cage(self):
+        mouse = Mouse.objects.get(name='1001-1')
+        mouse.cage = self.cages[1]
+        with CaptureQueriesContext(connection) as context:
+            mouse.save()
+        self.assertEqual(self.stale_cage_names(), ['1001', '1002'])
+        for query in context.captured_queries:
+            self.assertNotIn('"colony_mouse"."pure_wild_type" FROM',
+                query['sql'])
+        
+        # Moving again marks the cage it was moved out of the second time
+        colony.census.refresh_census_rows([cage.pk for cage in self.cages])
+        mouse.cage = self.cages[2]
+        mouse.save()
+        self.assertEqual(self.stale_cage_names(), ['1002', '1003'])
+    
+    def test_moves_mouse_loaded_without_cage(self):
+        mouse = Mouse.objects.only('name').get(name='1001-1')
+        mouse.cage = self.cages[1]
+        mouse.save()
+        self.assertEqual(self.stale_cage_names(), ['1001', '1002'])
+
+class AutocompleteCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bob', password='password')
+        Mouse.objects.create(name='1001-1', sex=0)
+    
+    def setUp(self):
+        # The cache is shared by every test in this process
+        colony.result_cache.autocomplete_results.invalidate()
+        self.client.force_login(self.user)
+    
+    def get_names(self):
+        """Returns the names found and whether the mice were queried"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(
+                reverse('colony:mouse-autocomplete'), {'q': '1001'})
+        names = [result['text'] for result in response.json()['results']]
+        queried = any('"colony_mouse"' in query['sql']
+            for query in context.captured_queries)
+        return names, queried
+    
+    def test_saving_a_mouse_invalidates_results(self):
+        self.assertEqual(self.get_names(), (['1001-1'], True))
+        self.assertEqual(self.get_names(), (['1001-1'], False))
+        
+        mouse = Mouse.objects.get(name='1001-1')
+        mouse.name = '1001-2'
+        mouse.save()
+        self.assertEqual(self.get_names(), (['1001-2'], True))
+        
+        Mouse.objects.create(name='1001-3', sex=1)
+        self.assertEqual(self.get_names(), (['1001-2', '1001-3'], True))
+
+class AddPupsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        alice = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+        cls.cage = Cage.objects.create(name='1001', proprietor=alice)
+        cls.strain = Strain.objects.create(name='C57')
+        cls.genes = [Gene.objects.create(name=name, gene_type=n_gene)
+            for n_gene, name in enumerate(['Emx-Cre', 'Ai14'])]
+        
+        # Parents of the same strain, each with one gene
+        parents = []
+        for name, sex, gene in [('father', 0, cls.genes[0]),
+                ('mother', 1, cls.genes[1])]:
+            parent = Mouse.objects.create(name=name, sex=sex, cage=cls.cage)
+            MouseGene.objects.create(
+                mouse_name=parent, gene_name=gene, zygosity='+/-')
+            MouseStrain.objects.create(
+                mouse_key=parent, strain_key=cls.strain, weight=1)
+            parents.append(parent)
+        
+        cls.litter = Litter.objects.create(breeding_cage=cls.cage,
+            proprietor=alice, father=parents[0], mother=parents[1],
+            dob=datetime.date.today())
+    
+    def assert_pups(self, names):
+        pups = list(self.litter.mouse_set.order_by('name'))
+        self.assertEqual([pup.name for pup in pups], names)
+        for pup in pups:
+            self.assertEqual(pup.cage, self.cage)
+            self.assertEqual(pup.sex, 2)
+            self.assertEqual(
+                sorted(pup.mousegene_set.values_list(
+                'gene_name__name', 'zygosity')),
+                [('Ai14', '?/?'), ('Emx-Cre', '?/?')])
+            self.assertEqual(
+                list(pup.mousestrain_set.values_list(
+                'strain_key__name', 'weight')),
+                [('C57', 1)])
+            
+            # The stored copies match what is computed from the database
+            self.assertEqual(pup.genotype_cache, pup.genotype)
+            self.assertEqual(pup.strain_cache, pup.strain_description)
+            
+            # Each was created once in the history
+            self.assertEqual(list(pup.history.values_list(
+                'history_type', flat=True)), ['+'])
+    
+    def test_adds_pups(self):
+        add_pups_to_litter(self.litter, 4)
+        self.assert_pups(['1001-1', '1001-2', '1001-3', '1001-4'])
+        
+        # Adding more continues the numbering
+        add_pups_to_litter(self.litter, 5)
+        self.assert_pups(['1001-1', '1001-2', '1001-3', '1001-4', '1001-5'])
+    
+    def test_skips_names_already_taken(self):
+        Mouse.objects.create(name='1001-2', sex=0)
+        add_pups_to_litter(self.litter, 3)
+        self.assert_pups(['1001-1', '1001-3'])
+    
+    def test_skips_name_taken_during_creation(self):
+        # Another request takes a name after the taken names were read
+        Mouse.objects.create(name='1001-2', sex=0)
+        taken_mouse_names = colony.views.taken_mouse_names
+        with mock.patch('colony.views.taken_mouse_names',
+                side_effect=[set(), taken_mouse_names(['1001-2'])]):
+            add_pups_to_litter(self.litter, 3)
+        self.assert_pups(['1001-1', '1001-3'])
+
+def create_breeding_cage(person, name, pup_sexes):
+    """Create a breeding cage with two parents and a litter of pups.
+    
+    Returns: the Cage
+    """
+    cage = Cage.objects.create(name=name, proprietor=person, location=4)
+    father = Mouse.objects.create(name=name + '-father', sex=0, cage=cage)
+    mother = Mouse.objects.create(name=name + '-mother', sex=1, cage=cage)
+    litter = Litter.objects.create(breeding_cage=cage, proprietor=person,
+        father=father, mother=mother,
+        dob=datetime.date.today() - datetime.timedelta(days=21))
+    for n_pup, sex in enumerate(pup_sexes):
+        Mouse.objects.create(name='{}-{}'.format(name, n_pup + 1), sex=sex,
+            cage=cage, litter=litter)
+    return cage
+
+class WeanLitterTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bob', password='password')
+        cls.person = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+    
+    def setUp(self):
+        self.client.force_login(self.user)
+    
+    def wean(self, cage):
+        colony.census.refresh_census_rows([cage.pk])
+        response = self.client.post(reverse('colony:wean', args=[cage.pk]))
+        self.assertEqual(response.status_code, 302)
+    
+    def test_moves_pups_into_a_cage_per_sex(self):
+        cage = create_breeding_cage(self.person, '1001', [0, 1, 0, 2, 1])
+        self.wean(cage)
+        
+        pups_by_cage = {}
+        for mouse in Mouse.objects.select_related('cage').order_by('name'):
+            pups_by_cage.setdefault(mouse.cage.name, []).append(mouse.name)
+        self.assertEqual(pups_by_cage, {
+            '1001': ['1001-father', '1001-mother'],
+            '1001-M': ['1001-1', '1001-3'],
+            '1001-F': ['1001-2', '1001-5'],
+            '1001-PUP': ['1001-4'],
+        })
+        
+        # The new cages are weaning cages where the breeding cage is
+        for new_cage in Cage.objects.exclude(pk=cage.pk):
+            self.assertEqual(new_cage.dar_type, 2)
+            self.assertEqual(new_cage.location, 4)
+            self.assertEqual(new_cage.proprietor, self.person)
+        self.assertEqual(Litter.objects.get(breeding_cage=cage).date_weaned,
+            datetime.date.today())
+    
+    def test_only_creates_cages_for_sexes_present(self):
+        cage = create_breeding_cage(self.person, '1001', [1, 1])
+        self.wean(cage)
+        self.assertEqual(sorted(Cage.objects.values_list('name', flat=True)),
+            ['1001', '1001-F'])
+    
+    def test_records_history_with_user(self):
+        cage = create_breeding_cage(self.person, '1001', [0, 1])
+        self.wean(cage)
+        
+        for name in ['1001-M', '1001-F']:
+            record = Cage.objects.get(name=name).history.get()
+            self.assertEqual(record.history_type, '+')
+            self.assertEqual(record.history_user, self.user)
+        
+        for pup in Mouse.objects.filter(litter__isnull=False):
+            latest = pup.history.latest()
+            self.assertEqual(latest.history_type, '~')
+            self.assertEqual(latest.cage_id, pup.cage_id)
+            self.assertEqual(latest.history_user, self.user)
+            self.assertEqual(pup.history.count(), 2)
+    
+    def test_marks_breeding_cage_stale(self):
+        cage = create_breeding_cage(self.person, '1001', [0])
+        self.wean(cage)
+        self.assertTrue(CageCensusRow.objects.get(cage=cage).stale)
+    
+    def test_moves_nothing_if_a_cage_name_is_taken(self):
+        cage = create_breeding_cage(self.person, '1001', [0, 1])
+        Cage.objects.create(name='1001-F', proprietor=self.person)
+        with self.assertRaises(IntegrityError):
+            colony.services.wean_litter(cage)
+        
+        self.assertFalse(Cage.objects.filter(name='1001-M').exists())
+        self.assertEqual(Mouse.objects.filter(cage=cage).count(), 4)
+        self.assertIsNone(Litter.objects.get(breeding_cage=cage).date_weaned)
+
+class SackCagesTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bob', password='password')
+        cls.person = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+    
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.cage = create_breeding_cage(self.person, '1001', [0, 1])
+        self.sacked_before = datetime.date(2020, 1, 1)
+        Mouse.objects.filter(name='1001-2').update(
+            sack_date=self.sacked_before)
+    
+    def sack(self, cage):
+        response = self.client.post(reverse('colony:sack', args=[cage.pk]))
+        self.assertEqual(response.status_code, 302)
+    
+    def test_sacks_cage_and_mice(self):
+        other_cage = create_breeding_cage(self.person, '1002', [0])
+        self.sack(self.cage)
+        
+        self.cage.refresh_from_db()
+        self.assertTrue(self.cage.defunct)
+        self.assertEqual(dict(Mouse.objects.filter(cage=self.cage).values_list(
+            'name', 'sack_date')), {
+            '1001-father': datetime.date.today(),
+            '1001-mother': datetime.date.today(),
+            '1001-1': datetime.date.today(),
+            '1001-2': self.sacked_before,
+        })
+        
+        # Other cages are left alone
+        other_cage.refresh_from_db()
+        self.assertFalse(other_cage.defunct)
+        self.assertFalse(Mouse.objects.filter(
+            cage=other_cage, sack_date__isnull=False).exists())
+    
+    def test_records_history_with_user(self):
+        self.sack(self.cage)
+        
+        latest = self.cage.history.latest()
+        self.assertEqual(latest.history_type, '~')
+        self.assertTrue(latest.defunct)
+        self.assertEqual(latest.history_user, self.user)
+        
+        for mouse in Mouse.objects.filter(cage=self.cage).exclude(
+                name='1001-2'):
+            latest = mouse.history.latest()
+            self.assertEqual(latest.history_type, '~')
+            self.assertEqual(latest.sack_date, datetime.date.today())
+            self.assertEqual(latest.history_user, self.user)
+        
+        # The mouse that was already sacked gets no new history
+        self.assertEqual(
+            Mouse.objects.get(name='1001-2').history.count(), 1)
+    
+    def test_sacking_twice_changes_nothing(self):
+        colony.services.sack_cages([self.cage.pk],
+            sack_date=datetime.date(2021, 1, 1))
+        self.assertEqual(colony.services.sack_cages([self.cage.pk]), (0, 0))
+        self.assertEqual(Mouse.objects.filter(
+            cage=self.cage, sack_date=datetime.date(2021, 1, 1)).count(), 3)
+    
+    def test_changes_nothing_if_a_write_fails(self):
+        bulk_history_create = HistoryManager.bulk_history_create
+        def fail_for_mice(manager, objs, *args, **kwargs):
+            if objs and isinstance(objs[0], Mouse):
+                raise IntegrityError('simulated failure')
+            return bulk_history_create(manager, objs, *args, **kwargs)
+        
+        ## The cages are already updated when the mouse history fails
+        with mock.patch.object(HistoryManager, 'bulk_history_create',
+                autospec=True, side_effect=fail_for_mice):
+            with self.assertRaises(IntegrityError):
+                colony.services.sack_cages([self.cage.pk])
+        
+        self.cage.refresh_from_db()
+        self.assertFalse(self.cage.defunct)
+        self.assertEqual(self.cage.history.count(), 1)
+        self.assertEqual(Mouse.objects.filter(
+            cage=self.cage, sack_date__isnull=True).count(), 3)
+
+class SearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.person = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+        gene = Gene.objects.create(name='Emx-Cre', gene_type=0)
+        strain = Strain.objects.create(name='C57 BL6')
+        
+        # A breeding cage whose father has since been moved out
+        cage = Cage.objects.create(name='1001', proprietor=cls.person)
+        father = Mouse.objects.create(name='1001-father', sex=0, cage=cage)
+        MouseGene.objects.create(
+            mouse_name=father, gene_name=gene, zygosity='+/-')
+        MouseStrain.objects.create(
+            mouse_key=father, strain_key=strain, weight=1)
+        mother = Mouse.objects.create(name='1001-mother', sex=1, cage=cage)
+        Litter.objects.create(breeding_cage=cage, proprietor=cls.person,
+            father=father, mother=mother, dob=datetime.date.today())
+        
+        father.cage = Cage.objects.create(name='2001', proprietor=cls.person)
+        father.save()
+        Cage.objects.create(name='3001', proprietor=cls.person)
+    
+    def search(self, search_term):
+        return sorted(colony.search.search_cages(
+            Cage.objects.all(), search_term).values_list('name', flat=True))
+    
+    def document(self, cage_name):
+        return CageSearchDocument.objects.get(
+            cage__name=cage_name).document.split('\n')
+    
+    def test_finds_gene_and_strain_names(self):
+        self.assertEqual(self.search('emx-cre'), ['1001', '2001'])
+        self.assertEqual(self.search('C57'), ['2001'])
+        self.assertEqual(self.search('nothing'), [])
+    
+    def test_finds_litter_target_genotype(self):
+        # Only the litter of the breeding cage still has the father's gene
+        self.assertNotIn('Emx-Cre', self.document('1001'))
+        self.assertIn('Emx-Cre',
+            Litter.objects.get(breeding_cage__name='1001').target_genotype)
+        self.assertEqual(self.search('Emx'), ['1001', '2001'])
+    
+    def test_quoted_term_is_one_word(self):
+        self.assertEqual(self.search('"C57 BL6"'), ['2001'])
+        self.assertEqual(self.search('BL6 C57'), ['2001'])
+        self.assertEqual(self.search('"BL6 C57"'), [])
+    
+    def test_moving_a_mouse_updates_both_documents(self):
+        mouse = Mouse.objects.get(name='1001-mother')
+        mouse.cage = Cage.objects.get(name='3001')
+        mouse.save()
+        
+        self.assertNotIn('1001-mother', self.document('1001'))
+        self.assertIn('1001-mother', self.document('3001'))
+        self.assertEqual(self.search('1001-mother'), ['3001'])
+    
+    def test_documents_after_adding_pups_and_weaning(self):
+        litter = Litter.objects.get(breeding_cage__name='1001')
+        add_pups_to_litter(litter, 2)
+        self.assertEqual(self.search('1001-2'), ['1001'])
+        
+        colony.services.wean_litter(litter.breeding_cage)
+        self.assertEqual(self.document('1001-PUP'),
+            ['1001-PUP', '1001-1', '1001-2', 'Emx-Cre'])
+        self.assertEqual(self.document('1001'), ['1001', '1001-mother'])
+        self.assertEqual(self.search('1001-2'), ['1001-PUP'])
+    
+    @override_settings(STATICFILES_STORAGE=
+        'django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_admin_search(self):
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('admin:colony_cage_changelist'),
+            {'q': '"C57 BL6"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [cage.name for cage in response.context['cl'].result_list],
+            ['2001'])
+
+class HistoryFeedTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('bob', password='password')
+        alice = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+        for number in range(1001, 1004):
+            cage = Cage.objects.create(name=str(number), proprietor=alice)
+            for n_mouse in range(3):
+                Mouse.objects.create(
+                    name='{}-{}'.format(number, n_mouse + 1), sex=2, cage=cage)
+        
+        # Many records at exactly the same time
+        same_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        Mouse.history.update(history_date=same_time)
+        Cage.history.update(history_date=same_time)
+    
+    def test_pages_do_not_skip_simultaneous_records(self):
+        querysets = colony.history.feed_querysets()
+        all_records = colony.history.merge_history_feed(querysets, 100)
+        self.assertEqual(len(all_records), 12)
+        
+        paged_records = []
+        before = None
+        while True:
+            page = colony.history.merge_history_feed(querysets, 5, before)
+            paged_records += page
+            if len(page) < 5:
+                break
+            before = colony.history.feed_position(page[-1])
+        
+        self.assertEqual(
+            [colony.history.feed_position(record) for record in paged_records],
+            [colony.history.feed_position(record) for record in all_records])
+    
+    def test_diffs_versions_recorded_at_the_same_time(self):
+        mouse = Mouse.objects.get(name='1001-1')
+        mouse.notes = 'moved'
+        mouse.save()
+        
+        # setUpTestData gave every record the same time, so set it again
+        same_time = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        Mouse.history.filter(id=mouse.pk).update(history_date=same_time)
+        
+        records = colony.history.merge_history_feed(
+            colony.history.feed_querysets(), 100)
+        newest = [record for record in records
+            if record.feed_model == 'Mouse' and record.id == mouse.pk][0]
+        self.assertEqual(newest.notes, 'moved')
+        
+        previous = colony.history.previous_records([newest])
+        old_record = previous[(type(newest), newest.prev_history_id)]
+        changes = colony.history.diff_records(old_record, newest)
+        self.assertEqual([change['field'] for change in changes], ['notes'])
+    
+    def test_invalid_before_is_bad_request(self):
+        self.client.force_login(self.user)
+        for params in [
+                {'before': '2024-13-45T00:00:00'},
+                {'before': 'yesterday'},
+                {'before': '2024-01-01T00:00:00', 'before_model': 'Mouse'},
+                {'before': '2024-01-01T00:00:00', 'before_model': 'Person',
+                    'before_id': '1'},
+                {'n': 'abc'},
+                {'n': '-5'},
+                {'n': '0'},
+                {'n': '501'},
+                ]:
+            response = self.client.get(reverse('colony:records'), params)
+            self.assertEqual(response.status_code, 400)
+
+# The admin templates use {% static %}, which needs a manifest otherwise
+@override_settings(STATICFILES_STORAGE=
+    'django.contrib.staticfiles.storage.StaticFilesStorage')
+class CageAdminChangelistTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.person = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+
+    def create_breeding_cages(self, first_number, n_cages):
+        """Create breeding cages, each with parents, pups, and a request"""
+        for number in range(first_number, first_number + n_cages):
+            cage = Cage.objects.create(
+                name=str(number), proprietor=self.person)
+            father = Mouse.objects.create(
+                name='{}-father'.format(number), sex=0, cage=cage)
+            mother = Mouse.objects.create(
+                name='{}-mother'.format(number), sex=1, cage=cage,
+                user=self.person)
+            litter = Litter.objects.create(breeding_cage=cage,
+                proprietor=self.person, father=father, mother=mother,
+                dob=datetime.date.today() - datetime.timedelta(days=20))
+            for n_pup in range(3):
+                Mouse.objects.create(name='{}-{}'.format(number, n_pup + 1),
+                    sex=2, cage=cage, litter=litter)
+            SpecialRequest.objects.create(cage=cage, message='check',
+                requestee=self.person)
+
+    def count_changelist_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('admin:colony_cage_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries)
+
+    def test_num_queries_does_not_grow_with_cages(self):
+        self.client.force_login(self.superuser)
+        self.create_breeding_cages(1001, 2)
+        n_queries = self.count_changelist_queries()
+
+        # Many more cages, all still on the first page
+        self.create_breeding_cages(1101, 30)
+        self.assertEqual(self.count_changelist_queries(), n_queries)
+
+class EstimatedCountPaginatorTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.superuser = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        cls.person = Person.objects.create(
+            name='alice', login_name='alice', series_number=1)
+    
+    def create_cages(self, first_number, n_cages):
+        for number in range(first_number, first_number + n_cages):
+            Cage.objects.create(name=str(number), proprietor=self.person)
+    
+    def analyze_cages(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE colony_cage')
+    
+    def paginator(self, object_list, exact_count_threshold):
+        paginator = EstimatedCountPaginator(object_list, 2)
+        paginator.exact_count_threshold = exact_count_threshold
+        return paginator
+    
+    def test_counts_exactly_below_threshold(self):
+        self.create_cages(1001, 3)
+        self.analyze_cages()
+        paginator = self.paginator(Cage.objects.all(), 10)
+        self.assertEqual(paginator.count, 3)
+        self.assertFalse(paginator.count_is_estimate)
+        with self.assertRaises(EmptyPage):
+            paginator.validate_number(3)
+    
+    def test_counts_exactly_if_never_analyzed(self):
+        # ANALYZE is not rolled back with the test, so use a table that no
+        # test analyzes. Its reltuples is -1 until it is first analyzed.
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT reltuples FROM pg_class "
+                "WHERE oid = 'colony_person'::regclass")
+            self.assertLess(cursor.fetchone()[0], 0)
+        
+        paginator = self.paginator(Person.objects.all(), 1)
+        self.assertIsNone(paginator.estimate_count())
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.count_is_estimate)
+    
+    def test_estimates_above_threshold(self):
+        self.create_cages(1001, 3)
+        self.analyze_cages()
+        paginator = self.paginator(Cage.objects.all(), 1)
+        self.assertEqual(paginator.count, 3)
+        self.assertTrue(paginator.count_is_estimate)
+        
+        # A filtered queryset is estimated by the planner
+        paginator = self.paginator(Cage.objects.filter(name='1001'), 1)
+        self.assertGreaterEqual(paginator.count, 1)
+        self.assertTrue(paginator.count_is_estimate)
+    
+    def test_allows_pages_past_estimate(self):
+        self.create_cages(1001, 3)
+        self.analyze_cages()
+        self.create_cages(1004, 2)
+        paginator = self.paginator(Cage.objects.order_by('name'), 1)
+        self.assertEqual(paginator.num_pages, 2)
+        self.assertEqual(paginator.validate_number(3), 3)
+        self.assertEqual([cage.name for cage in paginator.page(3)], ['1005'])
+        self.assertEqual(list(paginator.page(4)), [])
+        with self.assertRaises(EmptyPage):
+            paginator.validate_number(0)
+    
+    @override_settings(STATICFILES_STORAGE=
+        'django.contrib.staticfiles.storage.StaticFilesStorage')
+    def test_changelist_links_past_estimate(self):
+        self.client.force_login(self.superuser)
+        self.create_cages(1001, 5)
+        
+        with mock.patch.object(EstimatedCountPaginator, 'estimate_count',
+                return_value=3), \
+                mock.patch.object(EstimatedCountPaginator,
+                'exact_count_threshold', 1), \
+                mock.patch.object(CageAdmin, 'list_per_page', 2):
+            response = self.client.get(
+                reverse('admin:colony_cage_changelist'), {'p': 2})
+            self.assertContains(response, 'about 3 cages')
+            self.assertContains(response, '<a href="?p=3">3</a>', html=True)
+            
+            # The last page is not full, so it links no further
+            response = self.client.get(
+                reverse('admin:colony_cage_changelist'), {'p': 3})
+            self.assertContains(response,
+                '<span class="this-page">3</span>', html=True)
+            self.assertNotContains(response, '?p=4')
@@ -3,19 +3,25 @@ from builtins import range
 from django.shortcuts import render
 from django.views import generic
 from django.core.exceptions import FieldDoesNotExist
-from django.db import IntegrityError
-from django.http import HttpResponseRedirect, HttpResponse
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Func, OuterRef, Q, Subquery
+from django.db.models.functions import Lower
+from django.contrib.postgres.search import TrigramSimilarity
+from django.http import (HttpResponseRedirect, HttpResponse,
+    HttpResponseBadRequest, JsonResponse)
+from urllib.parse import urlencode
 import datetime
 
 from .models import (Mouse, Cage, Litter, generate_cage_name,
     Person,
     have_same_single_gene,
-    HistoricalCage, HistoricalMouse, MouseGene, Gene, Genotype,
+    MouseGene, Gene, Genotype,
     Strain, MouseStrain)
 from .forms import (MatingCageForm, SackForm, AddGenotypingInfoForm,
     ChangeNumberOfPupsForm, CensusFilterForm, WeanForm, SetMouseSexForm, SetMouseToesForm)
 from simple_history.models import HistoricalRecords
-from itertools import chain
+from simple_history.utils import (
+    bulk_create_with_history, bulk_update_with_history)
 
 # I think there's a thread problem with importing pyplot here
 # Maybe if you specify matplotlib.use('Agg') it would be okay
@@ -23,6 +29,12 @@ from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
 from matplotlib.figure import Figure
 
 import colony.models
+import colony.census
+import colony.history
+import colony.occupancy
+import colony.result_cache
+import colony.search
+import colony.services
 import pandas
 
 from dal import autocomplete
@@ -33,62 +45,97 @@ from colony.models import Mouse
 # https://django-autocomplete-light.readthedocs.io/en/master/tutorial.html
 # I can't figure how to use forward filtering in this version of dal
 # so separate ones for each
-class MouseAutocomplete(autocomplete.Select2QuerySetView):
-    """Autocomplete for all mice"""
+class MouseNameAutocomplete(autocomplete.Select2QuerySetView):
+    """Base class for the mouse autocomplete views.
+    
+    By default, matches mice whose name starts with the query, ignoring
+    case. This uses the index on LOWER(name), unlike name__istartswith.
+    
+    If the GET parameter 'fuzzy' is set, instead matches names that are
+    similar to the query using pg_trgm, most similar first, which
+    tolerates typos. This uses the trigram index on name.
+    
+    Subclasses override get_base_queryset to choose which mice to include.
+    Results are always ordered and limited to one page.
+    
+    The results are cached in colony.result_cache, keyed by the view, the
+    query, the forwarded sex, the page, and the fuzzy mode, so repeated
+    prefixes do not query the database.
+    """
+    paginate_by = 20
+    
+    def get(self, request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return super(MouseNameAutocomplete, self).get(
+                request, *args, **kwargs)
+        
+        key = (
+            type(self).__name__,
+            self.q,
+            self.forwarded.get('sex', None),
+            request.GET.get('page'),
+            bool(request.GET.get('fuzzy')),
+        )
+        
+        # Only hit the database if not cached
+        payload = colony.result_cache.autocomplete_results.get(key)
+        if payload is None:
+            self.object_list = self.get_queryset()
+            context = self.get_context_data()
+            payload = {
+                'results': self.get_results(context),
+                'pagination': {'more': self.has_more(context)},
+            }
+            colony.result_cache.autocomplete_results.set(key, payload)
+        
+        return JsonResponse(payload)
+    
+    def get_base_queryset(self):
+        """Returns the mice to search among"""
+        return Mouse.objects.all()
+    
     def get_queryset(self):
         if not self.request.user.is_authenticated:
             return Mouse.objects.none()
 
-        qs = Mouse.objects.all()
+        qs = self.get_base_queryset().order_by('name')
 
         if self.q:
-            qs = qs.filter(name__istartswith=self.q)
-
-        return qs        
-
-class UnsackedMouseAutocomplete(autocomplete.Select2QuerySetView):
-    """Autocomplete for unsacked mice"""
-    def get_queryset(self):
-        if not self.request.user.is_authenticated:
-            return Mouse.objects.none()
+            if self.request.GET.get('fuzzy'):
+                qs = qs.filter(name__trigram_similar=self.q).annotate(
+                    similarity=TrigramSimilarity('name', self.q),
+                ).order_by('-similarity', 'name')
+            else:
+                qs = qs.annotate(name_lower=Lower('name')).filter(
+                    name_lower__startswith=self.q.lower())
 
-        qs = Mouse.objects.filter(sack_date__isnull=True).all()
+        return qs
 
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
+class MouseAutocomplete(MouseNameAutocomplete):
+    """Autocomplete for all mice"""
+    pass
 
-        return qs      
+class UnsackedMouseAutocomplete(MouseNameAutocomplete):
+    """Autocomplete for unsacked mice"""
+    def get_base_queryset(self):
+        return Mouse.objects.filter(sack_date__isnull=True)
 
 # These two are for mating cage
-class FemaleMouseAutocomplete(autocomplete.Select2QuerySetView):
+class FemaleMouseAutocomplete(MouseNameAutocomplete):
     """Autocomplete for unsacked female mice"""
-    def get_queryset(self):
-        if not self.request.user.is_authenticated:
-            return Mouse.objects.none()
-
-        qs = Mouse.objects.filter(sex=1, sack_date__isnull=True).all()
+    def get_base_queryset(self):
+        qs = Mouse.objects.filter(sex=1, sack_date__isnull=True)
 
         sex = self.forwarded.get('sex', None)
         if sex:
             qs = qs.filter(sex=sex)
 
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
+        return qs
 
-        return qs       
-
-class MaleMouseAutocomplete(autocomplete.Select2QuerySetView):
+class MaleMouseAutocomplete(MouseNameAutocomplete):
     """Autocomplete for unsacked male mice"""
-    def get_queryset(self):
-        if not self.request.user.is_authenticated:
-            return Mouse.objects.none()
-
-        qs = Mouse.objects.filter(sex=0, sack_date__isnull=True).all()
-
-        if self.q:
-            qs = qs.filter(name__istartswith=self.q)
-
-        return qs       
+    def get_base_queryset(self):
+        return Mouse.objects.filter(sex=0, sack_date__isnull=True)
 
 
 def counts_by_person(request):
@@ -107,76 +154,29 @@ def counts_by_person(request):
         freq='W-WED')[::-1]
 
 
-    ## Iterate over target_dates
-    pc_l = []
-    for target_date in target_dates:
-        # Find the most recent historical cage record before target date, 
-        # distinct by each cage
-        qs1 = colony.models.HistoricalCage.objects.filter(
-            history_date__lte=target_date).order_by(
-            'id', '-history_date').distinct('id')
-
-        # Include only cages that were non-defunct and in 1710 at that time
-        # And also exclude any deleted cages
-        # I think cages that contained no mice are also included here
-        qs2 = colony.models.HistoricalCage.objects.filter(
-            history_id__in=qs1.values_list('history_id', flat=True), 
-            defunct=False, location__in=[0, 4]).exclude(history_type='-')
-
-        # Extract proprietor names
-        proprietor_names = qs2.values_list('proprietor__name', flat=True)
-
-        # Count them
-        proprietor_counts = pandas.Series(list(proprietor_names)).value_counts()
+    ## Count cages at every date
+    # The counts are read from DailyCageCount, and only the days since
+    # the last nightly refresh are replayed from the history
+    # The tabular dates are a subset of the daily dates, but include them
+    # explicitly in case that ever changes
+    all_target_dates = target_dates.union(tabular_target_dates)
+    all_counts = colony.occupancy.rollup_cage_counts(all_target_dates)
 
-        # Store
-        pc_l.append(proprietor_counts)
-
-    # Concat
-    df = pandas.concat(pc_l, axis=1, sort=True).fillna(0).astype(int)
-    df.columns = target_dates
-    
-    # Sort by usage
-    df = df.loc[df.sum(1).sort_values().index[::-1]]
-    
-    # Add a total
-    df.loc['total'] = df.sum(0)
-
-
-    ## Repeat everything above for tabular
-    tabular_pc_l = []
-    for target_date in tabular_target_dates:
-        # Find the most recent historical cage record before target date, 
-        # distinct by each cage
-        qs1 = colony.models.HistoricalCage.objects.filter(
-            history_date__lte=target_date).order_by(
-            'id', '-history_date').distinct('id')
-
-        # Include only cages that were non-defunct and in 1710 at that time
-        # And also exclude any deleted cages
-        # I think cages that contained no mice are also included here
-        qs2 = colony.models.HistoricalCage.objects.filter(
-            history_id__in=qs1.values_list('history_id', flat=True), 
-            defunct=False, location__in=[0, 4]).exclude(history_type='-')
-
-        # Extract proprietor names
-        proprietor_names = qs2.values_list('proprietor__name', flat=True)
-
-        # Count them
-        proprietor_counts = pandas.Series(list(proprietor_names)).value_counts()
-
-        # Store
-        tabular_pc_l.append(proprietor_counts)
+    def format_counts(dates):
+        """Extract the counts at `dates`, sorted by usage and with a total"""
+        # Include only people with cages at some of these dates
+        df = all_counts.loc[:, dates]
+        df = df.loc[df.sum(1) > 0]
+        
+        # Sort by usage
+        df = df.loc[df.sum(1).sort_values().index[::-1]]
+        
+        # Add a total
+        df.loc['total'] = df.sum(0)
+        return df
 
-    # Concat
-    tabular_df = pandas.concat(tabular_pc_l, axis=1, sort=True).fillna(0).astype(int)
-    tabular_df.columns = tabular_target_dates
-    
-    # Sort by usage
-    tabular_df = tabular_df.loc[tabular_df.sum(1).sort_values().index[::-1]]
-    
-    # Add a total
-    tabular_df.loc['total'] = tabular_df.sum(0)    
+    df = format_counts(target_dates)
+    tabular_df = format_counts(tabular_target_dates)
     
     
     ## Format tabular text
@@ -284,29 +284,13 @@ def census_by_cage_number(request, census_filter_form, proprietor,
     # Order by name
     qs = qs.order_by(order_by)
     
-    # Now select related
-    # I used to also prefetch_related on mouse_set__genotype but this
-    # stopped working
-    qs = qs.prefetch_related('mouse_set').\
-        prefetch_related('specialrequest_set').\
-        prefetch_related('specialrequest_set__requester').\
-        prefetch_related('specialrequest_set__requestee').\
-        prefetch_related('mouse_set__litter').\
-        prefetch_related('mouse_set__user').\
-        prefetch_related('litter__mouse_set').\
-        prefetch_related('litter__father__mousegene_set').\
-        prefetch_related('litter__mother__mousegene_set').\
-        prefetch_related('litter__father__mousegene_set__gene_name').\
-        prefetch_related('litter__mother__mousegene_set__gene_name').\
-        prefetch_related('mouse_set__mousegene_set').\
-        prefetch_related('mouse_set__mousegene_set__gene_name').\
-        select_related('litter', 'litter__father', 'litter__mother', 
-            'litter__mother__cage', # for contains_mother_of_this_litter
-            'proprietor', 'litter__proprietor')
+    # Read each cage's rows from the census snapshot
+    # Only the rows that are stale will be recomputed
+    object_list = colony.census.cages_with_census_rows(qs)
 
     return render(request, 'colony/index.html', {
         'form': census_filter_form,
-        'object_list': qs,
+        'object_list': object_list,
         'include_by_user': include_by_user,
     })
 
@@ -341,59 +325,11 @@ def census_by_genotype(request, census_filter_form, proprietor,
     if location != 'All':
         qs = qs.filter(location=location)
 
-    # Now select related
-    # I used to also prefetch_related on mouse_set__genotype but this
-    # stopped working    
-    qs = qs.prefetch_related('mouse_set').\
-        prefetch_related('specialrequest_set').\
-        prefetch_related('specialrequest_set__requester').\
-        prefetch_related('specialrequest_set__requestee').\
-        prefetch_related('mouse_set__litter').\
-        prefetch_related('mouse_set__user').\
-        prefetch_related('litter__mouse_set').\
-        prefetch_related('litter__father__mousegene_set').\
-        prefetch_related('litter__mother__mousegene_set').\
-        prefetch_related('litter__father__mousegene_set__gene_name').\
-        prefetch_related('litter__mother__mousegene_set__gene_name').\
-        prefetch_related('mouse_set__mousegene_set').\
-        prefetch_related('mouse_set__mousegene_set__gene_name').\
-        select_related('litter', 'litter__father', 'litter__mother', 
-            'litter__mother__cage', # for contains_mother_of_this_litter
-            'proprietor', 'litter__proprietor')
-
-    # Extract relevant genesets
-    relevant_genesets = [cage.relevant_genesets for cage in qs.all()]
-    unique_relevant_genesets = []
-    for rg in relevant_genesets:
-        for srg in rg:
-            tsrg = tuple(srg)
-            if tsrg not in unique_relevant_genesets:
-                unique_relevant_genesets.append(tsrg)
-    
-    # Sort by first gene, then number of genes
-    unique_relevant_genesets = sorted(unique_relevant_genesets, 
-        key=lambda v: (v[0] if len(v) > 0 else '', len(v)))
-
-    # Should remove this second iteration over qs.all() for SQL efficiency
-    # Just iterate once and save everything necessary
-    #
-    # Iterate once over cages and group by geneset
-    geneset2cage_l = {}
-    for cage in qs.all():
-        for geneset in cage.relevant_genesets:
-            if geneset in geneset2cage_l:
-                geneset2cage_l[geneset].append(cage)
-            else:
-                geneset2cage_l[geneset] = [cage]
-
-    # Now refactor
-    sorted_by_geneset = []
-    for geneset in unique_relevant_genesets:
-        sorted_by_geneset.append({
-            'geneset': geneset,
-            'dname': (' x '.join(geneset)) if len(geneset) > 0 else 'WT',
-            'cage_l': geneset2cage_l[geneset]
-        })
+    # Read each cage's rows from the census snapshot, which also stores
+    # its relevant genesets, and group the cages by geneset
+    cages = colony.census.cages_with_census_rows(qs)
+    sorted_by_geneset = colony.census.group_cages_by_geneset(cages,
+        genesets_of=lambda cage: cage.census_row.relevant_genesets)
 
     return render(request, 'colony/census_by_genotype.html', {
         'form': census_filter_form,
@@ -575,6 +511,75 @@ def make_mating_cage(request):
     return render(request, 'colony/new_mating_cage.html', {'form': form})
 
 
+def summary_table_data():
+    """Count the cages and mice of each person for the summary view.
+    
+    Every count comes from one of two grouped queries, one over Cage and
+    one over Mouse. The current counts are taken from the same queries by
+    conditional aggregation, instead of querying once per person.
+    
+    Returns: all_table_data, current_table_data
+        Each is a list of dicts with keys 'name', 'cages', and 'mice', one
+        for each Person in order. all_table_data counts every cage and
+        ends with an entry for mice without a cage, named "No Cage".
+        current_table_data only counts non-defunct cages in 1710 that
+        contain at least one mouse, and the mice in non-defunct cages in
+        1710.
+    """
+    current_locations = [0, 4]
+    
+    # Count all cages and current cages by proprietor
+    # The join on mouse makes distinct necessary
+    cage_counts = {row['proprietor__name']: row for row in
+        Cage.objects.order_by().values('proprietor__name').annotate(
+            n_all=Count('id', distinct=True),
+            n_current=Count('id', distinct=True, filter=Q(
+                defunct=False,
+                location__in=current_locations,
+                mouse__isnull=False,
+            )),
+        )}
+    
+    # Count all mice and current mice by proprietor of their cage
+    # Mice without a cage are grouped under None
+    mouse_counts = {row['cage__proprietor__name']: row for row in
+        Mouse.objects.order_by().values('cage__proprietor__name').annotate(
+            n_all=Count('id'),
+            n_current=Count('id', filter=Q(
+                cage__defunct=False,
+                cage__location__in=current_locations,
+            )),
+        )}
+    
+    # Every person is listed, even with no cages
+    empty = {'n_all': 0, 'n_current': 0}
+    names = list(Person.objects.values_list('name', flat=True))
+    
+    # Contains information about all cages and mice stored in database
+    all_table_data = [{
+        'name': name,
+        'cages': cage_counts.get(name, empty)['n_all'],
+        'mice': mouse_counts.get(name, empty)['n_all'],
+    } for name in names]
+    
+    # Add entry for mice without a cage
+    all_table_data.append({
+        'name': 'No Cage',
+        'cages': 0,
+        'mice': mouse_counts.get(None, empty)['n_all'],
+    })
+    
+    # Contains information about only non-defunct cages
+    # Exclude empty cages
+    # Include only cages in 1710
+    current_table_data = [{
+        'name': name,
+        'cages': cage_counts.get(name, empty)['n_current'],
+        'mice': mouse_counts.get(name, empty)['n_current'],
+    } for name in names]
+    
+    return all_table_data, current_table_data
+
 def summary(request):
     """Returns cage and mouse counts by person for a summary view
     
@@ -596,39 +601,12 @@ def summary(request):
     'persons_current':
         Same as above, but only for cages for which defunct=False.
     """
-    persons = Person.objects.all()
-    mice = Mouse.objects.all()
-    cages = Cage.objects.all()
-
-    # Contains information about all cages and mice stored in database
-    all_table_data = [{ 
-        'name': person.name, 
-        'cages': cages.filter(proprietor=person).count(),
-        'mice': mice.filter(cage__proprietor=person).count(),
-    } for person in persons]
+    all_table_data, current_table_data = summary_table_data()
     
-    # Add entry for mice without a cage
-    all_table_data.append({
-        'name': 'No Cage',
-        'cages': 0,
-        'mice': mice.filter(cage__isnull=True).count()
-    })
     all_totals = {
         'cages' : sum([person['cages'] for person in all_table_data]), 
         'mice' : sum([person['mice'] for person in all_table_data])}
 
-    # Contains information about only non-defunct cages
-    # Exclude empty cages
-    # Include only cages in 1710
-    current_table_data = [{ 
-        'name': person.name, 
-        'cages': cages.filter(
-            proprietor=person, defunct=False, location__in=[0, 4]).exclude( 
-            mouse__isnull=True).count(),
-        'mice': mice.filter(cage__proprietor=person, 
-            cage__defunct=False, cage__location__in=[0, 4]).count(),
-    } for person in persons]
-
     current_totals = {
         'cages' : sum([person['cages'] for person in current_table_data]),
         'mice' : sum([person['mice'] for person in current_table_data])}
@@ -640,12 +618,24 @@ def summary(request):
         'current_totals' : current_totals,
     })
 
+# The most records that the records view shows on one page
+MAX_RECORDS = 500
+
 def records(request):
-    """ Returns a feed of Mouse and Cage model change
+    """ Returns a feed of Mouse, Cage, Litter, and SpecialRequest changes
     
     The historical record object is used to obtain the previous 50 model changes
     and identify which fields are altered in each
     
+    GET parameters:
+        proprietor : only show records of this person's cages, mice,
+            litters, and special requests
+        n : number of records to show (default 50, at most MAX_RECORDS)
+        before : only show records before this time, in ISO format.
+            The "Older records" link at the bottom of the page sets this,
+            along with before_model and before_id, to continue exactly
+            after the last record shown. See colony.history.feed_position.
+    
     Returns a request with "rec_summaries" in context data.
     rec_summaries is a list in chronological order.
     Each entry is a dict with the following fields:
@@ -663,117 +653,73 @@ def records(request):
     # get some filters from the URL
     proprietor = request.GET.get('proprietor')
     n_records = request.GET.get('n')
-    try:
-        n_records = int(n_records)
-    except TypeError:
+    if n_records is None:
         n_records = 50
+    else:
+        try:
+            n_records = int(n_records)
+        except ValueError:
+            return HttpResponseBadRequest('invalid n')
+        if not (1 <= n_records <= MAX_RECORDS):
+            return HttpResponseBadRequest(
+                'n must be between 1 and {}'.format(MAX_RECORDS))
+    
+    # Show only records after this position in the feed, to scroll back
+    before = request.GET.get('before')
+    if before:
+        try:
+            before = colony.history.parse_feed_position(before,
+                request.GET.get('before_model'), request.GET.get('before_id'))
+        except (TypeError, ValueError):
+            return HttpResponseBadRequest('invalid before parameters')
+    
+    # Merge the most recent historical records of each model
+    records = colony.history.merge_history_feed(
+        colony.history.feed_querysets(proprietor), n_records, before)
+    
+    # Link to the next page, if there might be one
+    if len(records) == n_records:
+        history_date, feed_model, history_id = colony.history.feed_position(
+            records[-1])
+        next_params = {'n': n_records, 'before': history_date.isoformat(),
+            'before_model': feed_model, 'before_id': history_id}
+        if proprietor:
+            next_params['proprietor'] = proprietor
+        next_page = '?' + urlencode(next_params)
+    else:
+        next_page = None
     
-    # Get all historical mouses and historical cages
-    mouse_records = Mouse.history
-    cage_records = Cage.history
-    if proprietor:
-        mouse_records = mouse_records.filter(
-            cage__proprietor__name__icontains=proprietor)
-        cage_records = cage_records.filter(
-            proprietor__name__icontains=proprietor)
-
-    # Merge the historical mouse and cage records
-    records = sorted(chain(mouse_records.all(), cage_records.all()),
-        key=lambda instance: instance.history_date, reverse=True)
-
-    # Take at most 50 records
-    records = records[:n_records]
-    
-    # Exclude these fields
-    exclude_fields = ['history_date', 'history_id', 'history_user',
-        'history_type']
+    # Get the previous version of every record at once, for comparison
+    previous = colony.history.previous_records(records)
 
     # Summarize each change
     rec_summaries = []
     for new_record in records:
-        ## First get the model name
-        if type(new_record) == HistoricalCage:
-            model = 'Cage'
-        elif type(new_record) == HistoricalMouse:
-            model = 'Mouse'
-        else:
-            raise ValueError("unknown model type")        
-        
-        ## Get the previous version of this object, for comparison
-        # This is the pk of the object that was changed
-        real_object_pk = new_record.instance.pk
-        
-        # Search for earlier historical objects with the same pk
-        change_datetime = new_record.history_date
-        hrecs_same_object = new_record.__class__.objects.filter(
-            id=real_object_pk, 
-            history_date__lt=change_datetime)
-        
-        # Take the most recent one that is before this one
-        old_record = hrecs_same_object.order_by('history_date').last()
-
         ## Store some metadata
         rec_summary = {
-            'model': model,
-            'name': new_record.name,
+            'model': new_record.feed_model,
+            'name': new_record.feed_name,
             'history_type': new_record.history_type,
             'history_user': str(new_record.history_user),
             'alter_time': new_record.history_date.strftime('%Y-%m-%d %H:%M-%S'),
         }
 
         ## Compare old and new records, if possible
+        old_record = previous.get(
+            (type(new_record), new_record.prev_history_id))
         if old_record is None:
             # No previous record to compare with
-            assert new_record.history_type == '+'
+            # This is usually a creation, but objects created before their
+            # history was tracked have no creation record
             rec_summary['changes'] = []
         else:
-            ## Find which fields differ between the 2 records
-            old_fields = type(old_record)._meta.get_fields()
-            new_fields = type(new_record)._meta.get_fields()
-            
-            # Identify which are present in the old but not the new
-            for field in old_fields:
-                # This will raise AttributeError if not present
-                getattr(new_record, field.name)
-            
-            # Iterate over all fields in the new
-            changes = []
-            for field in new_fields:
-                # Skip if excluded
-                fieldname = field.name
-                if fieldname in exclude_fields:
-                    continue
-                
-                # Get the old and new field values
-                # This will raise AttributeError if not present in old
-                old_field_value = getattr(old_record, fieldname)
-                new_field_value = getattr(new_record, fieldname)
-                change = {
-                    'field': fieldname,
-                    'old': old_field_value,
-                    'new': new_field_value,
-                }
-                
-                # Determine if this was added, deleted, changed, or nothing
-                if old_field_value is None and new_field_value is not None:
-                    change['type'] = 'addition'
-                elif new_field_value is None and old_field_value is not None:
-                    change['type'] = 'removal'
-                elif old_field_value != new_field_value:
-                    change['type'] = 'change'
-                else:
-                    # no change made to this field
-                    continue
-                
-                # Append change, if any
-                changes.append(change)
-
-            # Store in rec_summary and append
-            rec_summary['changes'] = changes
+            rec_summary['changes'] = colony.history.diff_records(
+                old_record, new_record)
         rec_summaries.append(rec_summary)
 
     return render(request, 'colony/records.html', {
-        'rec_summaries' : rec_summaries
+        'rec_summaries' : rec_summaries,
+        'next_page': next_page,
     })
 
 def sack(request, cage_id):
@@ -787,11 +733,7 @@ def sack(request, cage_id):
 
         if form.is_valid():
             #Make all cage/mice defunct
-            cage.defunct = True
-            cage.save()
-            for mouse in mice:
-                mouse.sack_date = datetime.date.today()
-                mouse.save()
+            colony.services.sack_cages([cage.pk])
             
             #redirect to census
             return HttpResponseRedirect('/colony/') 
@@ -930,26 +872,43 @@ def post_set_genotyping_info(request, litter):
     if genotyping_form.is_valid():
         # process the data in form.cleaned_data as required
         gene_name = genotyping_form.cleaned_data['gene_name']
-        for mouse in litter.mouse_set.all():
+        mice = list(litter.mouse_set.all())
+        
+        # Get the existing zygosity of every mouse for this gene at once
+        existing = dict(MouseGene.objects.filter(
+            mouse_name__in=mice, gene_name=gene_name).values_list(
+            'mouse_name_id', 'zygosity'))
+        
+        # Only write the MouseGene that are new or changed
+        mousegenes = []
+        for mouse in mice:
             result = genotyping_form.cleaned_data['result_%s' % mouse.name]
-            
-            # If the mouse gene already exists, change it
-            mgqs = MouseGene.objects.filter(
-                mouse_name=mouse, gene_name=gene_name)
-            
-            if mgqs.count() == 0:
-                # Create it
-                mg = MouseGene(
+            if existing.get(mouse.pk) != result:
+                mousegenes.append(MouseGene(
                     gene_name=gene_name,
                     mouse_name=mouse,
                     zygosity=result,
-                )
-                mg.save()
-            else:
-                # Edit it
-                mg = mgqs.first()
-                mg.zygosity = result
-                mg.save()
+                ))
+        
+        # Create or edit them all at once. The unique constraint on mouse
+        # and gene makes this safe against a concurrent submission
+        MouseGene.objects.bulk_create(mousegenes,
+            update_conflicts=True,
+            unique_fields=['mouse_name', 'gene_name'],
+            update_fields=['zygosity'],
+        )
+        
+        # Bulk writes do not send signals
+        genotyped_ids = [mg.mouse_name_id for mg in mousegenes]
+        colony.census.mark_mice_stale(genotyped_ids)
+        colony.models.refresh_mouse_caches(
+            colony.models.Mouse.objects.filter(pk__in=genotyped_ids))
+        colony.models.refresh_target_genotypes(
+            colony.models.Litter.objects.filter(
+            Q(father__in=genotyped_ids) | Q(mother__in=genotyped_ids)))
+        colony.search.refresh_search_documents(
+            colony.models.Cage.objects.filter(mouse__in=genotyped_ids)
+            .distinct())
         
         # Create a new, blank form (so the fields default to blank
         # rather than to the values we just entered)
@@ -970,13 +929,18 @@ def post_set_sex(request, litter):
     
     # Process if valid
     if set_sex_form.is_valid():
-        # Set the sex of each submitted mouse
+        # Set the sex of each submitted mouse that changed
+        changed_mice = []
         for mouse in litter.mouse_set.all():
-            sex = set_sex_form.cleaned_data['sex_%s' % mouse.name]
-            mouse.sex = sex
-            mouse.save()
+            # ChoiceField cleans to a string
+            sex = int(set_sex_form.cleaned_data['sex_%s' % mouse.name])
+            if mouse.sex != sex:
+                mouse.sex = sex
+                changed_mice.append(mouse)
+        bulk_update_mice(changed_mice, ['sex'])
     
     return set_sex_form
+
 def post_set_toes(request, litter):
     """Called when POST with set toes.
 
@@ -989,13 +953,37 @@ def post_set_toes(request, litter):
 
     # Process if valid
     if set_toes_form.is_valid():
-        # Set the sex of each submitted mouse
+        # Set the toes of each submitted mouse that changed
+        changed_mice = []
         for mouse in litter.mouse_set.all():
             toe = set_toes_form.cleaned_data['toe_clipped_%s' % mouse.name]
-            mouse.toe_clipped = toe
-            mouse.save()
+            if mouse.toe_clipped != toe:
+                mouse.toe_clipped = toe
+                changed_mice.append(mouse)
+        bulk_update_mice(changed_mice, ['toe_clipped'])
 
     return set_toes_form
+
+def bulk_update_mice(mice, fields):
+    """Save these fields of these mice at once, with their history.
+    
+    Does nothing if mice is empty, so a form submitted without changes
+    writes nothing.
+    """
+    if len(mice) == 0:
+        return
+    
+    bulk_update_with_history(mice, Mouse, fields)
+    
+    # Bulk updates do not send signals
+    colony.census.mark_mice_stale([mouse.pk for mouse in mice])
+    colony.result_cache.autocomplete_results.invalidate()
+
+def taken_mouse_names(names):
+    """Returns the set of these names that existing mice already have"""
+    return set(Mouse.objects.filter(name__in=names).values_list(
+        'name', flat=True))
+
 def add_pups_to_litter(litter, new_number_of_pups):
     """Calculates strains and genotypes, and adds pups to litter"""
     # Get strains of progeny
@@ -1036,37 +1024,67 @@ def add_pups_to_litter(litter, new_number_of_pups):
     if pup_is_pure_wild_type:
         pup_is_pure = True
 
-    # Add each pup in turn
-    for pupnum in range(litter.mouse_set.count(), new_number_of_pups):
-        # Create a new mouse
-        mouse = Mouse(
-            name='%s-%d' % (litter.breeding_cage.name, pupnum + 1),
-            sex=2,
-            litter=litter,
-            cage=litter.breeding_cage,
-            pure_breeder=pup_is_pure,
-            pure_wild_type=pup_is_pure_wild_type,
-        )
-        
-        # Try to save
+    # Name each new pup
+    pup_names = ['%s-%d' % (litter.breeding_cage.name, pupnum + 1)
+        for pupnum in range(litter.mouse_set.count(), new_number_of_pups)]
+    
+    # Every pup gets the same genes and strains, so their stored
+    # genotype and strain can be computed once, without querying
+    gene_list = list(gene_set)
+    genotype = colony.models.format_genotype(pup_is_pure_wild_type, [
+        MouseGene(gene_name=gene, zygosity='?/?') for gene in gene_list])
+    strain_description = colony.models.format_strain_description([
+        MouseStrain(strain_key=strain, weight=weight)
+        for strain, weight in zip(strains, strains_weight)])
+    
+    # Create all the pups at once, with their history
+    # Skip names that already exist due to naming the pups weirdly. If one
+    # is taken between reading them and creating the pups, every pup is
+    # rolled back, so read the taken names again and retry once.
+    for n_attempt in range(2):
+        existing_names = taken_mouse_names(pup_names)
         try:
-            mouse.save()
+            with transaction.atomic():
+                mice = bulk_create_with_history([
+                    Mouse(
+                        name=pup_name,
+                        sex=2,
+                        litter=litter,
+                        cage=litter.breeding_cage,
+                        pure_breeder=pup_is_pure,
+                        pure_wild_type=pup_is_pure_wild_type,
+                        genotype_cache=genotype,
+                        strain_cache=strain_description,
+                    ) for pup_name in pup_names
+                    if pup_name not in existing_names
+                ], Mouse)
+                
+                # Add their genes
+                MouseGene.objects.bulk_create([
+                    MouseGene(mouse_name=mouse, gene_name=gene,
+                        zygosity='?/?')
+                    for mouse in mice for gene in gene_list
+                ])
+                
+                # Add their strains
+                MouseStrain.objects.bulk_create([
+                    MouseStrain(mouse_key=mouse, strain_key=strain,
+                        weight=weight)
+                    for mouse in mice
+                    for strain, weight in zip(strains, strains_weight)
+                ])
         except IntegrityError:
-            # Mouse already exists due to naming the pups weirdly
-            continue
-        
-        # Add its genes
-        for gene in gene_set:
-            mg = MouseGene(mouse_name=mouse, gene_name=gene,
-                zygosity='?/?')
-            mg.save()
-        
-        # Add its strains
-        for strain, weight in zip(strains, strains_weight):
-            ms = MouseStrain(
-                mouse_key=mouse, strain_key=strain, 
-                weight=weight)
-            ms.save()    
+            if n_attempt == 1:
+                raise
+        else:
+            break
+    
+    # Bulk creation does not send signals
+    colony.census.mark_mice_stale([mouse.pk for mouse in mice],
+        cage_ids=[litter.breeding_cage_id])
+    colony.result_cache.autocomplete_results.invalidate()
+    colony.search.refresh_search_documents(
+        Cage.objects.filter(pk=litter.breeding_cage_id))
 
 def get_strain_of_progeny(litter):
     """Calculate the strain of the progeny of a litter"""
@@ -1108,10 +1126,7 @@ def get_strain_of_progeny(litter):
 
 def wean(request, cage_id):
     """Wean pups in the cage's litter into new cages"""
-    cage = Cage.objects.get(pk=cage_id)
-    male_pups = cage.litter.mouse_set.filter(sex=0).all()
-    female_pups = cage.litter.mouse_set.filter(sex=1).all()
-    unk_pups = cage.litter.mouse_set.filter(sex=2).all()
+    cage = Cage.objects.select_related('litter').get(pk=cage_id)
 
     #If the form is being submitted
     if request.method == 'POST':
@@ -1119,59 +1134,19 @@ def wean(request, cage_id):
 
         if form.is_valid():
             # Create the cages and move the mice
-            if male_pups.count() > 0:
-                cage_name = cage.name + '-M'
-                male_cage = colony.models.Cage(
-                    name=cage_name,
-                    location=cage.location,
-                    proprietor=cage.proprietor,
-                    notes='',
-                    dar_type=2, # weaning type
-                )
-                male_cage.save()
-                for mouse in male_pups.all():
-                    mouse.cage = male_cage
-                    mouse.save()
-            
-            # same with females
-            if female_pups.count() > 0:
-                cage_name = cage.name + '-F'
-                female_cage = colony.models.Cage(
-                    name=cage_name,
-                    location=cage.location,
-                    proprietor=cage.proprietor,
-                    notes='',
-                    dar_type=2, # weaning type
-                )
-                female_cage.save()
-                for mouse in female_pups.all():
-                    mouse.cage = female_cage
-                    mouse.save()    
-
-            # same with unknown gender
-            if unk_pups.count() > 0:
-                cage_name = cage.name + '-PUP'
-                unk_cage = colony.models.Cage(
-                    name=cage_name,
-                    location=cage.location,
-                    proprietor=cage.proprietor,
-                    notes='',
-                    dar_type=2, # weaning type
-                )
-                unk_cage.save()
-                for mouse in unk_pups.all():
-                    mouse.cage = unk_cage
-                    mouse.save()    
-            
-            cage.litter.date_weaned = datetime.date.today()
-            cage.litter.save()
-
+            colony.services.wean_litter(cage)
 
             ## Redirect to a new mating cage form for the parents
             # Should redirect to a new mating cage form, or do that above
             # For now just redirect to the litter maintenance page
             return HttpResponseRedirect('/colony/')
 
+    # Show the pups that will be moved, from one query
+    pups_by_sex = colony.services.group_pups_by_sex(cage.litter.mouse_set.all())
+    male_pups = pups_by_sex[0]
+    female_pups = pups_by_sex[1]
+    unk_pups = pups_by_sex[2]
+
     return render(request, 'colony/wean.html', {
         'cage' : cage,
         'male_pups' : male_pups,
@@ -1180,90 +1155,103 @@ def wean(request, cage_id):
     })
 
 def current_litters(request):
-    """View for cages that need to be weaned
+    """View for litters that need attention
     
-    This view returns an HttpResponse containing metadata about all litters
-    that have been born but not weaned, and are not from a defunct
-    breeding cage. This metadata is displayed in a table with the following 
-    headings:
+    This view returns an HttpResponse containing three tables, all computed
+    from a single query on Litter.
+    
+    Litters born, waiting to wean: litters that have been born but not
+    weaned, and are not from a defunct breeding cage. Headings:
         'Cage', 'Sticker', 'DoBirth', 'Early wean', 'Late wean', 
         'Sexual maturity'
+    
+    Weaned litters needing a sex check: litters that have been weaned, but
+    still have unsacked pups whose sex is unknown. Headings:
+        'Cage', 'Sticker', 'DoBirth', 'Weaned', 'Unsexed pups',
+        'Sexual maturity'
+    
+    Mated pairs waiting on pups: litters that have not been born, and are
+    not from a defunct breeding cage. The pup check dates are the same as
+    in Litter.needs_pup_check. Headings:
+        'Cage', 'Sticker', 'Mated', 'Start pup check', 'Expect pups'
 
     Arguments:
         request : not used
     
     Returns: HttpResponse
-        This response contains the table described above.
+        This response contains the tables described above.
     """
-    # Find all Litter objects that are not weaned and are not from
-    # defunct cages
-    breeding = colony.models.Litter.objects.filter(
-        date_weaned=None, breeding_cage__defunct=False)
-    
-    # This queryset includes only those Litter that have been born
-    born = breeding.exclude(dob=None)
-    
-    
-    # Helper function
-    def get_weaning_dates():
-        """Return data about each litter in `born`.
-        
-        Returns : list, of the same length as `born`
-            Each entry is a tuple containing data about that litter
-                breeding_cage
-                sticker
-                DOB
-                earliest wean date
-                latest wean date
-                maturity date
-        """
-        # Keep track of weaning data here
-        weaning_data = []
-        
-        # Iterate over all litters that have been born but not weaned
-        for x in born:
-            # Get the sticker for the cage of the same name
-            sticker = colony.models.Cage.objects.filter(name=x)[0].sticker
-            
-            # Identify the earliest and latest possible wean dates
-            earliest_wean = x.dob + datetime.timedelta(days=19)
-            latest_wean = x.dob + datetime.timedelta(days=24)
-            
-            # Identify the time of maturity for this cage
-            maturity = x.dob + datetime.timedelta(days=7*5)
-            
-            # Store breeding_cage, sticker name, DOB, and the three dates above
-            results = (
-                x.breeding_cage, sticker, x.dob, 
-                earliest_wean, latest_wean, maturity,
-                )
-            weaning_data.append(results)
-        
-        return weaning_data
-    
-    # Get the data about each litter in `born`
-    weaning_data = get_weaning_dates()
-    
-    # Convert this data to a DataFrame
-    wean_tbl = pandas.DataFrame(weaning_data,
-        columns=[
-            'Cage', 'Sticker', 'DoBirth', 
-            'Early wean', 'Late wean', 'Sexual maturity',
-            ]
-        )
-    wean_tbl = wean_tbl.set_index('Cage')
-    
-    # Convert the table to HTML
-    wean_test = wean_tbl.to_html()
-    
-    # Write the table into an HttpResponse
-    response = HttpResponse('<h2>Litters born, waiting to wean</h2>')
-    response.write(wean_test)
+    # Count the unsacked pups of unknown sex in each litter
+    unsexed_pups = colony.models.Mouse.objects.filter(
+        litter=OuterRef('pk'), sex=2, sack_date__isnull=True).order_by(
+        ).annotate(n=Func(F('pk'), function='COUNT')).values('n')
+    
+    # Get every litter in any of the three tables at once
+    # Unweaned litters (born or not) are only from non-defunct cages
+    litters = colony.models.Litter.objects.annotate(
+        n_unsexed=Subquery(unsexed_pups),
+    ).filter(
+        Q(date_weaned=None, breeding_cage__defunct=False) |
+        Q(date_weaned__isnull=False, n_unsexed__gt=0)
+    ).order_by('breeding_cage__name').values(
+        'breeding_cage__name', 'breeding_cage__sticker', 
+        'date_mated', 'dob', 'date_weaned', 'n_unsexed')
+    
+    litters_df = pandas.DataFrame.from_records(litters, columns=[
+        'breeding_cage__name', 'breeding_cage__sticker', 
+        'date_mated', 'dob', 'date_weaned', 'n_unsexed'])
+    
+    # Convert to datetimes, so that the date math is vectorized
+    for column in ['date_mated', 'dob', 'date_weaned']:
+        litters_df[column] = pandas.to_datetime(litters_df[column])
+    
+    # Compute all the dates at once
+    litters_df['early_wean'] = litters_df['dob'] + pandas.Timedelta(days=19)
+    litters_df['late_wean'] = litters_df['dob'] + pandas.Timedelta(days=24)
+    litters_df['maturity'] = litters_df['dob'] + pandas.Timedelta(days=7*5)
+    litters_df['pup_check'] = (
+        litters_df['date_mated'] + pandas.Timedelta(days=20))
+    litters_df['expect_pups'] = (
+        litters_df['date_mated'] + pandas.Timedelta(days=25))
+    
+    # Split into the three tables
+    is_weaned = litters_df['date_weaned'].notnull()
+    is_born = litters_df['dob'].notnull()
+    tables = [
+        ('Litters born, waiting to wean', 
+            litters_df[is_born & ~is_weaned], {
+                'breeding_cage__name': 'Cage',
+                'breeding_cage__sticker': 'Sticker',
+                'dob': 'DoBirth',
+                'early_wean': 'Early wean',
+                'late_wean': 'Late wean',
+                'maturity': 'Sexual maturity',
+            }),
+        ('Weaned litters needing a sex check', 
+            litters_df[is_weaned], {
+                'breeding_cage__name': 'Cage',
+                'breeding_cage__sticker': 'Sticker',
+                'dob': 'DoBirth',
+                'date_weaned': 'Weaned',
+                'n_unsexed': 'Unsexed pups',
+                'maturity': 'Sexual maturity',
+            }),
+        ('Mated pairs waiting on pups', 
+            litters_df[~is_born & ~is_weaned], {
+                'breeding_cage__name': 'Cage',
+                'breeding_cage__sticker': 'Sticker',
+                'date_mated': 'Mated',
+                'pup_check': 'Start pup check',
+                'expect_pups': 'Expect pups',
+            }),
+    ]
     
-    # Add a TODO note at the end
-    response.write(
-        '<p>To do: add a table for weaned litters needing a sex check</p>'
-        '<p>Add a table for breeding pairs waiting on litters and dates to '
-        'start checking for pups</p>')
+    # Write each table into an HttpResponse
+    response = HttpResponse()
+    for title, table, columns in tables:
+        table = table[list(columns.keys())].rename(columns=columns)
+        table = table.set_index('Cage')
+        response.write('<h2>{}</h2>'.format(title))
+        response.write(table.to_html())
     
     return response
@@ -20,6 +20,7 @@ settings.DEBUG = True
 from django.db import connection
 import colony.views
 import colony.models
+import colony.census
 
 
 
@@ -85,53 +86,8 @@ def test3():
         select_related('litter', 'litter__father', 'litter__mother', 
             'proprietor', 'litter__proprietor')
     
-    # Extract relevant genesets
-    relevant_genesets = [cage.relevant_genesets for cage in qs.all()]
-    unique_relevant_genesets = []
-    for rg in relevant_genesets:
-        for srg in rg:
-            tsrg = tuple(srg)
-            if tsrg not in unique_relevant_genesets:
-                unique_relevant_genesets.append(tsrg)
-    
-    # Sort by first gene, then number of genes
-    unique_relevant_genesets = sorted(unique_relevant_genesets, 
-        key=lambda v: (v[0] if len(v) > 0 else '', len(v)))
-
-    # Iterate once over cages and group by geneset
-    geneset2cage_l = {}
-    for cage in qs.all():
-        for geneset in cage.relevant_genesets:
-            if geneset in geneset2cage_l:
-                geneset2cage_l[geneset].append(cage)
-            else:
-                geneset2cage_l[geneset] = [cage]
-
-    # Now refactor
-    sorted_by_geneset = []
-    for geneset in unique_relevant_genesets:
-        sorted_by_geneset.append({
-            'geneset': geneset,
-            'dname': (' x '.join(geneset)) if len(geneset) > 0 else 'WT',
-            'cage_l': geneset2cage_l[geneset]
-        })
-    return
-    
-    sorted_by_geneset = []
-    for geneset in unique_relevant_genesets:
-        cage_l = []
-        
-        # This loop triggers a lot of SQL queries
-        # I think it's just evaluating cage which has to happen anyway
-        for cage, relevant_geneset in zip(qs.all(), relevant_genesets):
-            if geneset in relevant_geneset:
-                cage_l.append(cage)
-        
-        sorted_by_geneset.append({
-            'geneset': geneset,
-            'dname': (' x '.join(geneset)) if len(geneset) > 0 else 'WT',
-            'cage_l': cage_l,
-        })
+    # Group by geneset, the same way as the census view
+    sorted_by_geneset = colony.census.group_cages_by_geneset(qs.all())
 
 def test4():
     qs = colony.models.Cage.objects.filter(defunct=False, proprietor__name__icontains='Chris')